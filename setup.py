@@ -5,5 +5,5 @@ setup(
     version="0.3",
     packages=find_packages(),
     include_package_data=False,
-    install_requires=["numpy", "opencv-contrib-python", "Pillow", "python-shogi"],
+    install_requires=["numpy", "opencv-contrib-python", "Pillow"],
 )
@@ -1,3 +1,36 @@
 # -*- coding: UTF-8 -*-
 
-from .imagesolver import *
+import importlib
+
+# 公開するクラスと定義しているモジュール、最初に参照したときにモジュールを読み込む
+# (sfen形式の局面・棋譜だけを扱う場合は、OpenCV・numpy・Pillowを読み込まない)
+_EXPORTS = {
+    "ImageSolver": "imagesolver",
+    "UsiEngine": "usiengine",
+    "UsiEnginePool": "enginepool",
+    "BoardImage": "boardimage",
+    "CsaConverter": "csaconverter",
+    "KomaClassifier": "komaclassifier",
+    "MateCache": "matecache",
+    "ImageCache": "imagecache",
+    "GeometryCache": "geometrycache",
+    "Sfen2kif": "sfen2kif",
+    "Csa2Sfen": "csa2sfen",
+    "Position": "position",
+    "tracer": "instrument",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module("." + module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import argparse
+import contextlib
+import functools
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# python -m shogiimagesolver.batch でも実行できるように、パッケージ内かどうかで判定する
+if __package__:
+    from .boardimage import BoardImage
+    from .csaconverter import CsaConverter
+    from .geometrycache import GeometryCache
+    from .imagesolver import ImageSolver
+else:
+    from boardimage import BoardImage
+    from csaconverter import CsaConverter
+    from geometrycache import GeometryCache
+    from imagesolver import ImageSolver
+
+"""大量の画像をまとめて解析するツール
+
+画像解析は複数プロセスで並行して行い、詰み探索は親プロセスの限られた数のエンジンで行う"""
+
+DEFAULT_INPUT = "./**/testin/*.jpg"
+
+# ワーカープロセスごとの画像解析器
+_converter = None
+_geometry_cache = None
+_out_dir = None
+
+
+def _init_worker(out_dir, quiet):
+    """ワーカープロセスの初期化、サンプル画像の読み込みは1度だけ行う"""
+    global _converter, _geometry_cache, _out_dir
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    _converter = CsaConverter()
+    _geometry_cache = GeometryCache()
+    _out_dir = out_dir
+
+
+def result_file_name(out_dir, file_name):
+    """画像ごとの出力ファイル名(拡張子なし)"""
+    basename_without_ext = os.path.splitext(os.path.basename(file_name))[0]
+    return os.path.join(out_dir, "result_" + basename_without_ext)
+
+
+def _recognize(file_name):
+    """画像を解析してsfen形式に変換し、盤部分を切り抜いた画像を保存する"""
+    try:
+        board_image = BoardImage.from_file(file_name, _geometry_cache)
+    except OSError:
+        return (file_name, "image_NG", None, None)
+    if not board_image.is_board:
+        return (file_name, "image_NG", None, None)
+    board_image.trimmed_image().save(result_file_name(_out_dir, file_name) + ".png")
+    csa = _converter.from_board_image(board_image)
+    if _converter.position is None:
+        return (file_name, "parse_NG", None, csa)
+    sfen = _converter.position.sfen()
+    return (file_name, None, sfen, csa)
+
+
+def find_files(inputs):
+    """ファイル名・ディレクトリ名・globパターンから画像ファイルの一覧を作る"""
+    files = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            for ext in ("jpg", "jpeg", "png"):
+                files.extend(glob.glob(os.path.join(pattern, "*." + ext)))
+        else:
+            files.extend(glob.glob(pattern, recursive=True))
+    return sorted(set(files))
+
+
+def load_done(out_dir, report, files):
+    """前回までに解析が終わっている画像"""
+    done = set()
+    if report and os.path.isfile(report):
+        with open(report, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    # 詰み探索で例外が起きた画像は、もう一度詰み探索する
+                    if "error" not in entry:
+                        done.add(entry["image"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+    for file_name in files:
+        if os.path.isfile(result_file_name(out_dir, file_name) + ".txt"):
+            done.add(file_name)
+    return done
+
+
+def write_result(out_dir, file_name, result, sfen, csa, kif_file=False):
+    """画像ごとの結果ファイルを出力する、kif_fileなら詰め手順をKIF形式の棋譜ファイルにも出力する"""
+    summary = (
+        "image="
+        + file_name
+        + ", result="
+        + result
+        + "\nsfen="
+        + sfen
+        + "\ncsa:\n"
+        + csa
+    )
+    print(summary)
+    with open(
+        result_file_name(out_dir, file_name) + ".txt", "w", encoding="utf-8"
+    ) as f:
+        f.write(summary)
+    if kif_file and result not in ("nomate", "timeout", "solve_NG"):
+        with open(
+            result_file_name(out_dir, file_name) + ".kif", "w", encoding="utf-8"
+        ) as f:
+            f.write(result)
+
+
+def run(
+    files,
+    out_dir="./testout",
+    report=None,
+    workers=None,
+    engines=1,
+    engine=None,
+    options=[],
+    resume=False,
+    quiet=False,
+    mate_wait=None,
+    kif_file=False,
+):
+    """画像を解析して(解析した枚数, 詰み探索した枚数, 不詰の枚数, 経過秒数)を返す"""
+    os.makedirs(out_dir, exist_ok=True)
+    if resume:
+        done = load_done(out_dir, report, files)
+        files = [file_name for file_name in files if file_name not in done]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    counts = {"processed": 0, "total": 0, "nomate": 0}
+    start = time.perf_counter()
+    redirect = open(os.devnull, "w") if quiet else sys.stdout
+    report_file = open(report, "a", encoding="utf-8") if report else None
+
+    lock = threading.Lock()
+
+    def record(file_name, result, sfen, csa, error=None):
+        with lock:
+            counts["processed"] += 1
+            if report_file:
+                line = {"image": file_name, "result": result, "sfen": sfen, "csa": csa}
+                if error is not None:
+                    line["error"] = error
+                report_file.write(json.dumps(line, ensure_ascii=False) + "\n")
+                report_file.flush()
+            if sfen is None:
+                return
+            counts["total"] += 1
+            if result == "nomate":
+                counts["nomate"] += 1
+            if error is not None:
+                # 結果ファイルは出力しないので、--resumeで詰み探索し直す
+                print("image=" + file_name + ", result=" + result + ", error=" + error)
+                return
+            write_result(out_dir, file_name, result, sfen, csa, kif_file)
+
+    def solved(file_name, sfen, csa, future):
+        """詰み探索が終わったら結果を出力する、例外ならsolve_NGとして例外を記録する"""
+        error = future.exception()
+        if error is not None:
+            record(file_name, "solve_NG", sfen, csa, repr(error))
+        else:
+            record(file_name, *future.result())
+
+    try:
+        # エンジンのスレッド・プロセスを作る前に、ワーカープロセスを作っておく
+        with contextlib.redirect_stdout(redirect), multiprocessing.Pool(
+            workers, initializer=_init_worker, initargs=(out_dir, quiet)
+        ) as pool:
+            solver = ImageSolver(
+                engine=engine,
+                options=options,
+                pool_size=engines,
+                image_cache=False,
+                kif_file=kif_file,
+            )
+            try:
+                with ThreadPoolExecutor(max_workers=engines) as executor:
+                    for (file_name, result, sfen, csa) in pool.imap_unordered(
+                        _recognize, files
+                    ):
+                        if sfen is None:
+                            record(file_name, result, sfen, csa)
+                            continue
+                        # 詰み探索が終わったものから結果を出力する
+                        future = executor.submit(
+                            solver.solve_from_sfen, sfen, csa, mate_wait
+                        )
+                        future.add_done_callback(
+                            functools.partial(solved, file_name, sfen, csa)
+                        )
+            finally:
+                solver.quit()
+    finally:
+        if report_file:
+            report_file.close()
+        if quiet:
+            redirect.close()
+    return (
+        counts["processed"],
+        counts["total"],
+        counts["nomate"],
+        time.perf_counter() - start,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="将棋アプリのスクリーンショット画像をまとめて解析する")
+    parser.add_argument("inputs", nargs="*", help="画像ファイル/ディレクトリ/globパターン")
+    parser.add_argument("--out", default="./testout", help="出力ディレクトリ")
+    parser.add_argument("--report", help="全画像の結果をJSON Lines形式で追記するファイル")
+    parser.add_argument("--workers", type=int, help="画像解析のプロセス数")
+    parser.add_argument("--engines", type=int, default=1, help="起動するエンジンの数")
+    parser.add_argument("--engine", help="詰将棋エンジンのパス")
+    parser.add_argument("--hash", type=int, default=128, help="エンジンのUSI_HASH")
+    parser.add_argument("--mate-wait", type=float, help="1局面あたりの詰み探索の待ち時間(秒)")
+    parser.add_argument("--kif", action="store_true", help="詰め手順をKIF形式の棋譜ファイルにも出力する")
+    parser.add_argument("--resume", action="store_true", help="結果が出力済みの画像は解析しない")
+    parser.add_argument("--quiet", action="store_true", help="途中経過を出力しない")
+    args = parser.parse_args(argv)
+    files = find_files(args.inputs or [DEFAULT_INPUT])
+    (processed, total, nomate_num, elapsed) = run(
+        files,
+        out_dir=args.out,
+        report=args.report,
+        workers=args.workers,
+        engines=args.engines,
+        engine=args.engine,
+        options=[("USI_HASH", args.hash)],
+        resume=args.resume,
+        quiet=args.quiet,
+        mate_wait=args.mate_wait,
+        kif_file=args.kif,
+    )
+    print(
+        "images="
+        + str(processed)
+        + ", elapsed="
+        + "%.1f" % elapsed
+        + "s, throughput="
+        + "%.2f" % (processed / elapsed if elapsed > 0 else 0.0)
+        + " images/sec"
+    )
+    print("nomate/total = " + str(nomate_num) + "/" + str(total))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+# python -m shogiimagesolver.benchmark でも実行できるように、パッケージ内かどうかで判定する
+if __package__:
+    from .boardimage import BoardImage
+    from .csaconverter import CsaConverter
+    from .komaclassifier import KomaClassifier
+    from .instrument import tracer
+    from .synthetic import SyntheticBoard, random_sfen
+else:
+    from boardimage import BoardImage
+    from csaconverter import CsaConverter
+    from komaclassifier import KomaClassifier
+    from instrument import tracer
+    from synthetic import SyntheticBoard, random_sfen
+
+"""合成したスクリーンショット画像で、盤上の駒の判定方法ごとの速度と正解率を比較するツール
+
+--importsを指定すると、代わりにパッケージのimportにかかる時間を新しいプロセスで計測する"""
+
+SFEN_NAMES = {
+    "P": "FU",
+    "L": "KY",
+    "N": "KE",
+    "S": "GI",
+    "G": "KI",
+    "B": "KA",
+    "R": "HI",
+    "K": "OU",
+    "+P": "TO",
+    "+L": "NY",
+    "+N": "NK",
+    "+S": "NG",
+    "+B": "UM",
+    "+R": "RY",
+}
+
+
+def sfen_squares(sfen):
+    """sfen形式の盤面を、CSA形式の駒(" * "/"+FU"など)81マス分のリストにする"""
+    squares = []
+    promoted = ""
+    for c in sfen.split()[0]:
+        if c.isdigit():
+            squares.extend([" * "] * int(c))
+        elif c == "+":
+            promoted = "+"
+        elif c != "/":
+            teban = "+" if c.isupper() else "-"
+            squares.append(teban + SFEN_NAMES[promoted + c.upper()])
+            promoted = ""
+    return squares
+
+
+def csa_squares(csa):
+    """CSA形式の局面から、盤上の駒81マス分のリストを取り出す"""
+    squares = []
+    for line in csa.split("\n")[:9]:
+        squares.extend([line[2 + k * 3 : 5 + k * 3] for k in range(9)])
+    return squares
+
+
+# import時間を計測する文と、読み込まれたかを確認する重いモジュール
+IMPORT_STATEMENTS = [
+    "import shogiimagesolver",
+    "from shogiimagesolver import Sfen2kif",
+    "from shogiimagesolver import ImageSolver",
+    "import cv2, numpy, PIL.Image, asyncio",
+]
+HEAVY_MODULES = ["cv2", "numpy", "PIL.Image", "asyncio"]
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+%s
+elapsed = time.perf_counter() - start
+print(elapsed, *[m for m in %r if m in sys.modules])
+"""
+
+
+def import_times(statements=IMPORT_STATEMENTS, repeat=5):
+    """文ごとに新しいプロセスでimportにかかる時間を計測し、(中央値のミリ秒, 読み込まれた重いモジュール)を返す"""
+    env = dict(os.environ)
+    # ソースのままでもパッケージとしてimportできるようにする
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        p for p in [package_root, env.get("PYTHONPATH")] if p
+    )
+    results = {}
+    for statement in statements:
+        times = []
+        for _ in range(repeat):
+            output = subprocess.run(
+                [sys.executable, "-c", IMPORT_SCRIPT % (statement, HEAVY_MODULES)],
+                env=env,
+                stdout=subprocess.PIPE,
+                check=True,
+                universal_newlines=True,
+            ).stdout.split()
+            times.append(float(output[0]))
+        results[statement] = {
+            "median_ms": statistics.median(times) * 1000,
+            "heavy_modules": output[1:],
+        }
+    return results
+
+
+def run(
+    classifiers, count=100, width=1080, height=2400, quality=90, seed=0, model_file=None
+):
+    """判定方法ごとに(正解マス率, 正解局面率, 1局面あたりの解析秒数, 1局面あたりの駒判定秒数)を返す"""
+    rng = random.Random(seed)
+    synthetic_board = SyntheticBoard(width, height)
+    boards = []
+    for _ in range(count):
+        sfen = random_sfen(rng)
+        board_image = BoardImage.from_bytes(synthetic_board.render_jpeg(sfen, quality))
+        boards.append((sfen_squares(sfen), board_image))
+    results = {}
+    enabled = tracer.enabled
+    tracer.enable()
+    try:
+        for classifier in classifiers:
+            converter = CsaConverter(classifier=classifier, model_file=model_file)
+            tracer.stats.clear()
+            correct_squares = 0
+            correct_boards = 0
+            start = time.perf_counter()
+            for (expected, board_image) in boards:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    csa = converter.from_board_image(board_image)
+                if csa is None:
+                    continue
+                correct = sum(1 for (a, b) in zip(expected, csa_squares(csa)) if a == b)
+                correct_squares += correct
+                if correct == 81:
+                    correct_boards += 1
+            elapsed = time.perf_counter() - start
+            classify = tracer.stats.summary().get("classify", {"total": 0.0})
+            results[classifier] = {
+                "square_accuracy": correct_squares / (81 * count),
+                "board_accuracy": correct_boards / count,
+                "sec_per_board": elapsed / count,
+                "classify_sec_per_board": classify["total"] / count,
+            }
+    finally:
+        tracer.stats.clear()
+        if not enabled:
+            tracer.disable()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="合成画像で盤上の駒の判定方法の速度と正解率を比較する")
+    parser.add_argument(
+        "--classifier",
+        action="append",
+        choices=CsaConverter.CLASSIFIERS,
+        help="比較する判定方法(省略時は全て)",
+    )
+    parser.add_argument("--count", type=int, default=100, help="局面の数")
+    parser.add_argument("--width", type=int, default=1080)
+    parser.add_argument("--height", type=int, default=2400)
+    parser.add_argument("--quality", type=int, default=90, help="JPEGの品質")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--model", help="modelで使う学習済みの分類器(komaclassifier.pyで作ったファイル)")
+    parser.add_argument("--imports", action="store_true", help="importにかかる時間を計測する")
+    parser.add_argument("--repeat", type=int, default=5, help="--importsの計測回数")
+    args = parser.parse_args(argv)
+    if args.imports:
+        print(json.dumps(import_times(repeat=args.repeat), indent=2))
+        return
+    classifiers = args.classifier
+    if not classifiers:
+        # 学習済みの分類器がなければmodelは比較しない
+        model_file = args.model or os.environ.get(
+            "SHOGI_KOMA_MODEL", KomaClassifier.DEFAULT_FILE
+        )
+        classifiers = [
+            classifier
+            for classifier in CsaConverter.CLASSIFIERS
+            if classifier != "model" or os.path.isfile(model_file)
+        ]
+    results = run(
+        classifiers,
+        count=args.count,
+        width=args.width,
+        height=args.height,
+        quality=args.quality,
+        seed=args.seed,
+        model_file=args.model,
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
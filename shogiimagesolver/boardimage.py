@@ -1,14 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
-import numpy as np
-import cv2
-from PIL import Image
+import io
 import glob
 
+if __name__ == "__main__" or __package__ == "":
+    from instrument import tracer
+    from lazyimport import lazy_import
+else:
+    from .instrument import tracer
+    from .lazyimport import lazy_import
+
+# numpy・OpenCV・Pillowは最初に使うときに読み込む
+np = lazy_import("numpy", globals(), "np")
+cv2 = lazy_import("cv2", globals())
+Image = lazy_import("PIL.Image", globals(), "Image")
+
 
 class BoardImage:
-    def __init__(self, image):
+    # 高さがこの行数の2倍以上の画像は、まず行を間引いて粗く走査する(Noneなら間引かない)
+    COARSE_ROWS = 512
+
+    def __init__(self, image, geometry_cache=None):
         self.image = image
         # imageが将棋盤かどうかはまだわからない
         self.is_board = False
@@ -17,7 +30,31 @@ class BoardImage:
             # 横長画像には非対応
             return
         # 白黒変換
-        self.image_gray = self.image.convert("L")
+        with tracer.stage("decode"):
+            self.image_gray = self.image.convert("L")
+            self.image_gray_cv = BoardImage.pil2cv(self.image_gray)
+        with tracer.stage("localize"):
+            if geometry_cache:
+                self.__localize_with_cache(geometry_cache)
+            else:
+                self.__localize()
+
+    @staticmethod
+    def from_file(file_name, geometry_cache=None):
+        im = Image.open(file_name)
+        return BoardImage(im, geometry_cache)
+
+    @staticmethod
+    def from_bytes(data, geometry_cache=None):
+        im = Image.open(io.BytesIO(data))
+        return BoardImage(im, geometry_cache)
+
+    def __localize(self):
+        """画像全体を走査して盤の位置を検出する"""
+        step = self.height // self.COARSE_ROWS if self.COARSE_ROWS else 1
+        if step >= 2 and self.__localize_coarse(step):
+            return
+        self.__prepare_profiles()
         self.__findHolizontalLine()
         if not self.is_board:
             # 横線が見つからなければ解析を中止
@@ -25,82 +62,216 @@ class BoardImage:
         self.__findVerticalLine()
         self.__calc_block()
 
-    @staticmethod
-    def from_file(file_name):
-        im = Image.open(file_name)
-        return BoardImage(im)
+    def __localize_with_cache(self, geometry_cache):
+        """同じサイズの画像で検出した盤の位置に線があれば、その位置を使う"""
+        size = (self.width, self.height)
+        geometry = geometry_cache.get(size)
+        if geometry is not None:
+            if self.__verify_geometry(geometry):
+                geometry_cache.hit()
+                return
+            self.is_board = False
+        geometry_cache.miss(rejected=geometry is not None)
+        self.__localize()
+        if self.is_board:
+            geometry_cache.put(size, self.geometry())
+
+    def geometry(self):
+        """盤の位置(上下左右の盤の端と盤内の線の端)"""
+        if not self.is_board:
+            return None
+        return (
+            self.board_top,
+            self.ban_top,
+            self.ban_bottom,
+            self.board_bottom,
+            self.board_left,
+            self.ban_left,
+            self.ban_right,
+            self.board_right,
+        )
+
+    def __is_line_rows(self, top, bottom):
+        """top行からbottom行の手前までの各行が横線かどうか"""
+        center = self.image_gray_cv[
+            max(top, 0) : max(bottom, 0), int(self.width / 4) : int(self.width / 4 * 3)
+        ]
+        return BoardImage.is_dark(center).all(axis=1)
+
+    def __is_line_row(self, y):
+        return 0 <= y < self.height and bool(self.__is_line_rows(y, y + 1)[0])
+
+    def __is_blank_row(self, y):
+        if not 0 <= y < self.height or self.__is_line_row(y):
+            return False
+        center = self.image_gray_cv[y, int(self.width / 4) : int(self.width / 4 * 3)]
+        return bool(BoardImage.is_bright(center).all())
+
+    def __localize_coarse(self, step):
+        """step行ごとに走査して盤の縁のおおよその位置を求め、その付近だけ全ての行を走査する
+
+        盤内の行は縦線が横切るので盤面色にはならず、間引いても盤の縁を飛ばすことはない。
+        見つけた位置は__verify_holizontal_lineで確認して、確認できなければFalseを返す"""
+        center = int(self.height / 2)
+        upper = self.__refine_holizontal_line(np.arange(center, 0, -1), step)
+        lower = self.__refine_holizontal_line(np.arange(center, self.height), step)
+        if upper is None or lower is None:
+            return False
+        ((board_top, ban_top), (board_bottom, ban_bottom)) = (upper, lower)
+        if not ban_top < center < ban_bottom:
+            return False
+        if not self.__verify_holizontal_line(
+            board_top, ban_top, ban_bottom, board_bottom
+        ):
+            self.is_board = False
+            return False
+        print(ban_top)
+        print(board_top)
+        print(ban_bottom)
+        print(board_bottom)
+        self.__findVerticalLine()
+        self.__calc_block()
+        return True
+
+    def __row_flags(self, rows):
+        """指定した行だけ、(横線か, 盤面色か)を判定する"""
+        center = self.image_gray_cv[rows, int(self.width / 4) : int(self.width / 4 * 3)]
+        line_rows = BoardImage.is_dark(center).all(axis=1)
+        blank_rows = BoardImage.is_bright(center).all(axis=1) & ~line_rows
+        return (line_rows, blank_rows)
+
+    def __refine_holizontal_line(self, positions, step):
+        """positionsをstep行ごとに走査して見つけた盤の縁の付近を、全ての行で走査し直す"""
+        (_, blank_rows) = self.__row_flags(positions[::step])
+        # 最初に盤面色になった行と、その後で盤面色でなくなった行の間に盤の縁がある
+        edge = BoardImage.__first_index(blank_rows)
+        if edge is None or edge == 0:
+            return None
+        board_edge = BoardImage.__first_index(~blank_rows[edge:])
+        if board_edge is None:
+            return None
+        start = max(edge - 2, 0) * step
+        end = min((edge + board_edge) * step + 1, len(positions))
+        band = positions[start:end]
+        (line_rows, blank_rows) = self.__row_flags(band)
+        (board_edge, ban_edge) = BoardImage.__scan_rows(band, line_rows, blank_rows)
+        if board_edge is None:
+            return None
+        return (board_edge, ban_edge)
+
+    def __verify_holizontal_line(self, board_top, ban_top, ban_bottom, board_bottom):
+        """盤の上下の縁の数行と、9等分した位置の横線だけを調べて、盤があるか確認する"""
+        # 盤内の線の端は横線で、その外側は横線ではない
+        if not (self.__is_line_row(ban_top) and self.__is_line_row(ban_bottom)):
+            return False
+        if self.__is_line_row(ban_top - 1) or self.__is_line_row(ban_bottom + 1):
+            return False
+        # 盤の端の内側は盤面色で、盤の端は盤面色ではない
+        if not (
+            self.__is_blank_row(board_top + 1) and self.__is_blank_row(board_bottom - 1)
+        ):
+            return False
+        if self.__is_blank_row(board_top) or self.__is_blank_row(board_bottom):
+            return False
+        # 盤内の横線が、9等分した位置の近くにある
+        ban_height = ban_bottom - ban_top
+        tolerance = max(2, int(ban_height / 9 * 0.05))
+        for k in range(1, 9):
+            y = ban_top + int(ban_height / 9 * k)
+            if not self.__is_line_rows(y - tolerance, y + tolerance + 1).any():
+                return False
+        self.board_top = board_top
+        self.ban_top = ban_top
+        self.ban_bottom = ban_bottom
+        self.board_bottom = board_bottom
+        self.is_board = True
+        return True
+
+    def __verify_geometry(self, geometry):
+        """保存された盤の位置の数行・1行分だけを調べて、同じ位置に盤があるか確認する"""
+        if not self.__verify_holizontal_line(*geometry[:4]):
+            return False
+        # 縦線は1行分しか走査しないので、検出し直して比較する
+        self.__findVerticalLine()
+        if self.geometry() != tuple(geometry):
+            return False
+        self.__calc_block()
+        return self.is_board
 
     def trimmed_image(self):
         """持ち駒と盤の部分を切り抜いた画像(Pillow形式)を返す"""
         if not self.is_board:
             return self.image
+        return self.image.crop(self.trimmed_box())
+
+    def trimmed_box(self):
+        """持ち駒と盤の部分の範囲"""
+        if not self.is_board:
+            return None
         sente_mochigoma_bottom = self.ban_bottom + int(self.block_height * 1.5)
-        self.gote_mochigoma_box(0)
-        return self.image.crop(
-            (
-                self.board_left,
-                self.gote_mochigoma_top,
-                self.board_right,
-                sente_mochigoma_bottom,
-            )
+        return (
+            self.board_left,
+            self.gote_mochigoma_top,
+            self.board_right,
+            sente_mochigoma_bottom,
         )
 
-    def __is_dark_point(self, x, y):
-        return BoardImage.is_dark(self.image_gray.getpixel((x, y)))
+    def __prepare_profiles(self):
+        """行ごとの横線/盤面色の判定結果をまとめて求める"""
+        # 横幅の中央半分の範囲で判定する
+        center = self.image_gray_cv[:, int(self.width / 4) : int(self.width / 4 * 3)]
+        self.__line_rows = BoardImage.is_dark(center).all(axis=1)
+        # 横線と判定された行は盤面色の判定をしない
+        self.__blank_rows = BoardImage.is_bright(center).all(axis=1) & ~self.__line_rows
 
-    def __is_bright_point(self, x, y):
-        return BoardImage.is_bright(self.image_gray.getpixel((x, y)))
+    @staticmethod
+    def __first_index(flags):
+        """flagsの中で最初にTrueとなる位置を返す"""
+        hits = np.flatnonzero(flags)
+        if hits.size == 0:
+            return None
+        return int(hits[0])
 
-    def __findUpperHolizontalLine(self):
-        mid_h = int(self.height / 2)
-        board_top = None  # 盤の縁も含めた上辺
-        ban_top = None  # 盤内の線の上辺
-        for y in range(mid_h, 0, -1):
-            if self.__is_horizontal_line(y):
-                # 横線であるなら上辺かも
-                ban_top = y
-            elif ban_top and self.__is_horizontal_blank(y):
-                # 上辺かもしれないものが見つかっていて、
-                # 画面横幅の半分以上の範囲で縦線がないなら、盤の縁
-                board_top = y
-                break
-        if not board_top:
-            # 盤内の線の上辺が見当たらない
+    def __scan_holizontal_line(self, positions):
+        """positionsの順に行を走査して、(盤の端, 盤内の線の端)を返す"""
+        (board_edge, ban_edge) = BoardImage.__scan_rows(
+            positions, self.__line_rows[positions], self.__blank_rows[positions]
+        )
+        if ban_edge is not None:
+            print(ban_edge)
+        if board_edge is not None:
+            print(board_edge)
+        return (board_edge, ban_edge)
+
+    @staticmethod
+    def __scan_rows(positions, line_rows, blank_rows):
+        """各行の判定結果を順に見て、(盤の端, 盤内の線の端)を返す"""
+        first_line = BoardImage.__first_index(line_rows)
+        if first_line is None:
             return (None, None)
-        print(ban_top)
-        # 上辺から縦方向に上向きに走査して、盤の上端を見つける
-        for y in range(board_top, 0, -1):
-            if not self.__is_horizontal_blank(y):
-                print(y)
-                return (y, ban_top)
-        # 盤の上端が見当たらない
-        return (None, None)
+        # 横線が見つかった後で、画面横幅の半分以上の範囲で縦線がないなら、盤の縁
+        edge = BoardImage.__first_index(blank_rows[first_line:])
+        if edge is None:
+            # 盤内の線の端が見当たらない
+            return (None, None)
+        edge += first_line
+        # 盤の縁より手前で最後に見つかった横線が、盤内の線の端
+        ban_edge = int(positions[np.flatnonzero(line_rows[:edge])[-1]])
+        # 盤の縁からさらに走査して、盤の端を見つける
+        board_edge = BoardImage.__first_index(~blank_rows[edge:])
+        if board_edge is None:
+            # 盤の端が見当たらない
+            return (None, ban_edge)
+        board_edge = int(positions[edge + board_edge])
+        return (board_edge, ban_edge)
 
-    def __findLowerHolizontalLine(self):
+    def __findUpperHolizontalLine(self):
         # 中心から縦方向に上向きに走査して、盤の上端の横線を見つける
-        # 盤の下端の横線を見つける
-        board_bottom = None
-        ban_bottom = None
-        for y in range(int(self.height / 2), self.height):
-            if self.__is_horizontal_line(y):
-                # 横線であるなら下辺かも
-                ban_bottom = y
-            elif ban_bottom and self.__is_horizontal_blank(y):
-                # 下辺かもしれないものが見つかっていて、
-                # 画面横幅の半分以上の範囲で縦線がないなら、盤の縁
-                board_bottom = y
-                break
-        if not board_bottom:
-            # 盤内の線の下辺が見当たらない
-            return (None, None)
-        print(ban_bottom)
-        # 下辺から縦方向に下向きに走査して、盤の下端を見つける
-        for y in range(board_bottom, self.height):
-            if not self.__is_horizontal_blank(y):
-                print(y)
-                return (y, ban_bottom)
-        # 盤の上端が見当たらない
-        return (None, None)
+        return self.__scan_holizontal_line(np.arange(int(self.height / 2), 0, -1))
+
+    def __findLowerHolizontalLine(self):
+        # 中心から縦方向に下向きに走査して、盤の下端の横線を見つける
+        return self.__scan_holizontal_line(np.arange(int(self.height / 2), self.height))
 
     def __findHolizontalLine(self):
         (board_top, ban_top) = self.__findUpperHolizontalLine()
@@ -124,32 +295,31 @@ class BoardImage:
         self.is_board = True
 
     def __findVerticalLine(self):
+        bright = BoardImage.is_bright(self.image_gray_cv[self.ban_top])
         # 盤の左端を見つける
-        ban_top = self.ban_top
         ban_left = 0
-        for x in range(int(self.width / 4), 0, -1):
-            if self.__is_bright_point(x, ban_top):
-                ban_left = x + 1
-                break
+        x = BoardImage.__first_index(bright[int(self.width / 4) : 0 : -1])
+        if x is not None:
+            ban_left = int(self.width / 4) - x + 1
         print(ban_left)
         board_left = 0
-        for x in range(ban_left - 1, 0, -1):
-            if not self.__is_bright_point(x, ban_top):
-                board_left = x + 1
-                break
+        if ban_left > 1:
+            x = BoardImage.__first_index(~bright[ban_left - 1 : 0 : -1])
+            if x is not None:
+                board_left = ban_left - x
         # 盤の右端を見つける
         ban_right = self.width - 1
-        for x in range(int(self.width / 4 * 3), self.width):
-            if self.__is_bright_point(x, ban_top):
-                ban_right = x - 1
-                break
+        x = BoardImage.__first_index(bright[int(self.width / 4 * 3) :])
+        if x is not None:
+            ban_right = int(self.width / 4 * 3) + x - 1
         print(ban_right)
         board_right = ban_right
-        for x in range(ban_right + 1, self.width):
-            if self.__is_bright_point(x, ban_top):
-                board_right = x
+        if ban_right + 1 < self.width:
+            x = BoardImage.__first_index(~bright[ban_right + 1 :])
+            if x is None:
+                board_right = self.width - 1
             else:
-                break
+                board_right = ban_right + x
         self.ban_left = ban_left
         self.board_left = board_left
         self.ban_right = ban_right
@@ -163,20 +333,6 @@ class BoardImage:
     def is_bright(brightness):
         return brightness > 100
 
-    def __is_horizontal_line(self, y):
-        """横幅の半分以上が黒いこと"""
-        for x in range(int(self.width / 4), int(self.width / 4 * 3)):
-            if not self.__is_dark_point(x, y):
-                return False
-        return True
-
-    def __is_horizontal_blank(self, y):
-        """横幅の半分以上が盤面色かどうか"""
-        for x in range(int(self.width / 4), int(self.width / 4 * 3)):
-            if not self.__is_bright_point(x, y):
-                return False
-        return True
-
     def __calc_block(self):
         if not self.is_board:
             return
@@ -196,86 +352,136 @@ class BoardImage:
         self.edge_x = int(self.block_width * 0.05)
         if self.edge_x < 1:
             self.edge_x = 1
+        self.__prepare_boxes()
+
+    def __prepare_boxes(self):
+        """全マスと持ち駒の範囲を計算しておく"""
+        ys = [self.ban_top + int(self.ban_height / 9 * i) for i in range(9)]
+        xs = [self.ban_left + int(self.ban_width / 9 * j) for j in range(9)]
+        self.__masume_boxes = [
+            [
+                (
+                    x + self.edge_x,
+                    y + self.edge_y,
+                    x + self.block_width - self.edge_x,
+                    y + self.block_height - self.edge_y,
+                )
+                for x in xs
+            ]
+            for y in ys
+        ]
+        mochigoma_width = int(self.block_width * 0.99)
+        mochigoma_edge_y = int((self.ban_top - self.board_top) * 1.2)
+        self.gote_mochigoma_top = self.board_top - mochigoma_edge_y - self.block_height
+        self.sente_mochigoma_bottom = (
+            self.board_bottom + mochigoma_edge_y + self.block_height
+        )
+        self.__gote_mochigoma_boxes = []
+        self.__sente_mochigoma_boxes = []
+        for i in range(7):
+            x = self.ban_left + mochigoma_width * i
+            self.__gote_mochigoma_boxes.append(
+                (
+                    x,
+                    self.gote_mochigoma_top,
+                    x + mochigoma_width,
+                    self.gote_mochigoma_top + self.block_height,
+                )
+            )
+            self.__sente_mochigoma_boxes.append(
+                (
+                    x,
+                    self.board_bottom + mochigoma_edge_y,
+                    x + mochigoma_width,
+                    self.sente_mochigoma_bottom,
+                )
+            )
+
+    def __box_view(self, box):
+        """グレー画像の範囲をOpenCV形式で返す、画像内ならコピーせずにNumPyのビューを返す
+
+        画像からはみ出す部分は、Pillowのcropと同じく0で埋める"""
+        (left, top, right, bottom) = box
+        if left >= 0 and top >= 0 and right <= self.width and bottom <= self.height:
+            return self.image_gray_cv[top:bottom, left:right]
+        img = np.zeros((max(bottom - top, 0), max(right - left, 0)), dtype=np.uint8)
+        (x0, y0) = (max(left, 0), max(top, 0))
+        (x1, y1) = (min(right, self.width), min(bottom, self.height))
+        if x0 < x1 and y0 < y1:
+            img[y0 - top : y1 - top, x0 - left : x1 - left] = self.image_gray_cv[
+                y0:y1, x0:x1
+            ]
+        return img
 
     def masume_box(self, i, j):
         if not self.is_board:
             return None
-        y = self.ban_top + int(self.ban_height / 9 * i)
-        x = self.ban_left + int(self.ban_width / 9 * j)
-        return (
-            x + self.edge_x,
-            y + self.edge_y,
-            x + self.block_width - self.edge_x,
-            y + self.block_height - self.edge_y,
-        )
+        return self.__masume_boxes[i][j]
 
     def masume_box_image(self, i, j):
-        """OpenCv形式でグレー画像をひとマス分取得する"""
+        """OpenCv形式でグレー画像をひとマス分取得する(画像のビューなので書き換えないこと)"""
+        if not self.is_board:
+            return None
+        return self.__box_view(self.__masume_boxes[i][j])
+
+    def all_cells(self, size):
+        """全81マスをsize(幅, 高さ)に揃えて、(81, 高さ, 幅)の配列で返す"""
+        if not self.is_board:
+            return None
+        cells = np.empty((81, size[1], size[0]), dtype=np.uint8)
+        for i in range(9):
+            for j in range(9):
+                cv2.resize(
+                    self.__box_view(self.__masume_boxes[i][j]),
+                    size,
+                    dst=cells[i * 9 + j],
+                )
+        return cells
+
+    def ban_thumbnail(self, cell_size):
+        """盤面を1マスcell_size四方に縮小したグレー画像(OpenCV形式)"""
         if not self.is_board:
             return None
-        img = self.image_gray.crop(self.masume_box(i, j))
-        return BoardImage.pil2cv(img)
+        if not hasattr(self, "_BoardImage__thumbnails"):
+            self.__thumbnails = {}
+        if cell_size not in self.__thumbnails:
+            img = self.image_gray_cv[
+                self.ban_top : self.ban_bottom, self.ban_left : self.ban_right
+            ]
+            self.__thumbnails[cell_size] = cv2.resize(
+                img, (cell_size * 9, cell_size * 9), interpolation=cv2.INTER_AREA
+            )
+        return self.__thumbnails[cell_size]
 
     def gote_mochigoma_box(self, i):
         if not self.is_board:
             return None
-        gote_mochigoma_top = (
-            self.board_top
-            - int((self.ban_top - self.board_top) * 1.2)
-            - self.block_height
-        )
-        self.gote_mochigoma_top = gote_mochigoma_top
-        mochigoma_width = int(self.block_width * 0.99)
-        edge_x = 0
-        edge_y = 0
-        y = gote_mochigoma_top
-        x = self.ban_left + mochigoma_width * i
-        return (
-            x + edge_x,
-            y + edge_y,
-            x + mochigoma_width - edge_x,
-            y + self.block_height - edge_y,
-        )
+        return self.__gote_mochigoma_boxes[i]
 
     def sente_mochigoma_box(self, i):
         if not self.is_board:
             return None
-        edge_x = 0
-        edge_y = int((self.ban_top - self.board_top) * 1.2)
-        sente_mochigoma_bottom = self.board_bottom + edge_y + self.block_height
-        self.sente_mochigoma_bottom = sente_mochigoma_bottom
-        mochigoma_width = int(self.block_width * 0.99)
-        x = self.ban_left + mochigoma_width * i
-        return (
-            x + edge_x,
-            self.board_bottom + edge_y,
-            x + mochigoma_width - edge_x,
-            sente_mochigoma_bottom,
-        )
+        return self.__sente_mochigoma_boxes[i]
 
     def gote_mochigoma_box_image(self, i):
         """OpenCv形式でグレー画像を後手持ち駒をひとつ取得する"""
         if not self.is_board:
             return None
-        img = self.image_gray.crop(self.gote_mochigoma_box(i))
-        return BoardImage.pil2cv(img)
+        return self.__box_view(self.__gote_mochigoma_boxes[i])
 
     def sente_mochigoma_box_image(self, i):
         """OpenCv形式でグレー画像を先手持ち駒をひとつ取得する"""
         if not self.is_board:
             return None
-        img = self.image_gray.crop(self.sente_mochigoma_box(i))
-        return BoardImage.pil2cv(img)
+        return self.__box_view(self.__sente_mochigoma_boxes[i])
 
     def mochigoma_box_image(self, i, is_for_sente):
         """OpenCv形式でグレー画像を持ち駒をひとつ取得する"""
         if not self.is_board:
             return None
         if is_for_sente:
-            img = self.image_gray.crop(self.sente_mochigoma_box(i))
-        else:
-            img = self.image_gray.crop(self.gote_mochigoma_box(i))
-        return BoardImage.pil2cv(img)
+            return self.__box_view(self.__sente_mochigoma_boxes[i])
+        return self.__box_view(self.__gote_mochigoma_boxes[i])
 
     @staticmethod
     def pil2cv(image):
@@ -2,22 +2,60 @@
 # -*- coding: UTF-8 -*-
 
 import glob
+import os
 
 if __name__ == "__main__" or __package__ == "":
     from boardimage import BoardImage
     from komadetector import KomaDetector
+    from komaclassifier import KomaClassifier
     from mochigomadetector import MochigomaDetector
+    from instrument import tracer
+    from position import Position
+    from lazyimport import lazy_import
 else:
     from .boardimage import BoardImage
     from .komadetector import KomaDetector
+    from .komaclassifier import KomaClassifier
     from .mochigomadetector import MochigomaDetector
+    from .instrument import tracer
+    from .position import Position
+    from .lazyimport import lazy_import
+
+# numpy・OpenCVは最初に使うときに読み込む
+np = lazy_import("numpy", globals(), "np")
+cv2 = lazy_import("cv2", globals())
 
 
 class CsaConverter:
     KOMA_QTY = [99, 18, 4, 4, 4, 4, 2, 2, 2]
+    # 盤上の駒の判定方法(modelは学習済みの分類器、komaclassifier.pyで作る)
+    CLASSIFIERS = ["orb", "correlation", "model"]
+    # 前回の画像と比べるときの1マス・持ち駒1つあたりの縮小画像のサイズと、変わったとみなす画素値の差
+    CHANGE_CHECK_SIZE = (16, 16)
+    CHANGE_THRESHOLD = 24
 
-    def __init__(self, mochigoma_by_sente=True):
-        self.komaDetector = KomaDetector()
+    def __init__(self, mochigoma_by_sente=True, classifier="orb", model_file=None):
+        if classifier not in self.CLASSIFIERS:
+            raise ValueError("unknown classifier: " + str(classifier))
+        koma_classifier = None
+        if classifier == "model":
+            # 引数→環境変数→デフォルトの順
+            if not model_file:
+                model_file = os.environ.get(
+                    "SHOGI_KOMA_MODEL", KomaClassifier.DEFAULT_FILE
+                )
+            koma_classifier = KomaClassifier.load(model_file)
+        self.komaDetector = KomaDetector(koma_classifier=koma_classifier)
+        self.classifier = classifier
+        # correlationの場合、マスごとの相関係数
+        self.koma_scores = None
+        # 直前に解析した画像の、マスごとの駒と持ち駒ごとの(駒, 枚数)
+        self.komas = None
+        self.mochigomas = None
+        # 直前の解析で判定したマス・持ち駒の数
+        self.reclassified = 0
+        # 直前に解析した画像の局面
+        self.position = None
         self.mochigoma_by_sente = mochigoma_by_sente
         if mochigoma_by_sente:
             self.mochiGomaDetector = MochigomaDetector(sample_dir="mochigoma_sente")
@@ -32,20 +70,125 @@ class CsaConverter:
     def from_board_image(self, board_image):
         """画像を解析する"""
         if board_image is None or not board_image.is_board:
+            self.position = None
             return None
-        self.csalines = []
-        self.koma_count = [0] * 9
+        self.koma_scores = None
         self.board_image = board_image
-        self.__detect_koma()
-        self.__detect_mochigoma()
+        self.komas = self.__detect_koma(range(81), [None] * 81)
+        with tracer.stage("mochigoma"):
+            self.mochigomas = self.__detect_mochigoma(range(7), [None] * 7)
+        self.reclassified = 81 + 7
         return self.__csa()
 
-    def __detect_mochigoma(self):
-        self.__detect_half_mochigoma(self.mochigoma_by_sente)
-        self.__calc_rest_mochigoma(not self.mochigoma_by_sente)
+    def from_board_images(self, board_images):
+        """複数の画像を解析して、画像ごとに(CSA形式の局面棋譜, 局面)のリストを返す
+
+        correlation・modelでは、全ての画像の全てのマスを1回の行列積でまとめて判定する"""
+        boards = [
+            board_image
+            for board_image in board_images
+            if board_image is not None and board_image.is_board
+        ]
+        (koma_list, score_list) = self.__classify(
+            [(board_image, k) for board_image in boards for k in range(81)]
+        )
+        results = []
+        offset = 0
+        for board_image in board_images:
+            if board_image is None or not board_image.is_board:
+                self.position = None
+                results.append((None, None))
+                continue
+            self.board_image = board_image
+            self.komas = koma_list[offset : offset + 81]
+            self.koma_scores = None
+            if score_list is not None:
+                scores = score_list[offset : offset + 81]
+                self.koma_scores = [scores[i * 9 : i * 9 + 9] for i in range(9)]
+            offset += 81
+            with tracer.stage("mochigoma"):
+                self.mochigomas = self.__detect_mochigoma(range(7), [None] * 7)
+            self.reclassified = 81 + 7
+            results.append((self.__csa(), self.position))
+        return results
+
+    def from_board_image_incremental(
+        self, board_image, previous_board_image, previous_komas, previous_mochigomas
+    ):
+        """前回の画像と判定結果(komas, mochigomas)を元に、画素が変わったマス・持ち駒だけ判定し直して解析する"""
+        if board_image is None or not board_image.is_board:
+            self.position = None
+            return None
+        if (
+            previous_board_image is None
+            or not previous_board_image.is_board
+            or previous_board_image.geometry() != board_image.geometry()
+            or previous_komas is None
+            or previous_mochigomas is None
+        ):
+            # 盤の位置が違えばマスの範囲も違うので、全て判定する
+            return self.from_board_image(board_image)
+        self.koma_scores = None
+        self.board_image = board_image
+        with tracer.stage("diff"):
+            # 盤面全体を縮小して、マスごとの画素値の差をまとめて求める
+            size = self.CHANGE_CHECK_SIZE[0]
+            diff = np.abs(
+                board_image.ban_thumbnail(size).astype(np.int16)
+                - previous_board_image.ban_thumbnail(size)
+            )
+            changed = diff.reshape(9, size, 9, size).max(axis=(1, 3))
+            changed_komas = [
+                int(k) for k in np.flatnonzero(changed > self.CHANGE_THRESHOLD)
+            ]
+            changed_mochigomas = [
+                i
+                for i in range(7)
+                if CsaConverter.is_changed(
+                    board_image.mochigoma_box_image(i, True),
+                    previous_board_image.mochigoma_box_image(i, True),
+                )
+            ]
+        self.komas = self.__detect_koma(changed_komas, list(previous_komas))
+        with tracer.stage("mochigoma"):
+            self.mochigomas = self.__detect_mochigoma(
+                changed_mochigomas, list(previous_mochigomas)
+            )
+        self.reclassified = len(changed_komas) + len(changed_mochigomas)
+        return self.__csa()
+
+    @staticmethod
+    def is_changed(img, previous_img):
+        """2つの画像を縮小して比べて、画素値の差が大きければ変わったとみなす"""
+        if img.shape != previous_img.shape:
+            return True
+        small = cv2.resize(
+            img, CsaConverter.CHANGE_CHECK_SIZE, interpolation=cv2.INTER_AREA
+        )
+        previous_small = cv2.resize(
+            previous_img, CsaConverter.CHANGE_CHECK_SIZE, interpolation=cv2.INTER_AREA
+        )
+        return (
+            cv2.norm(small, previous_small, cv2.NORM_INF)
+            > CsaConverter.CHANGE_THRESHOLD
+        )
 
     def __csa(self):
-        """CSA形式の局面棋譜を返す"""
+        """判定結果から局面を作り、CSA形式の局面棋譜を返す"""
+        position = Position()
+        for (k, koma) in enumerate(self.komas):
+            position.board[k] = Position.CSA_CODES[koma]
+        side = 0 if self.mochigoma_by_sente else 1
+        for (koma, qty) in self.mochigomas:
+            if qty > 0:
+                position.hands[side][Position.KIND_CODES[koma]] = qty
+        # 残りの駒は相手の持ち駒とする
+        koma_count = position.koma_count()
+        for i in range(1, 8):
+            position.hands[1 - side][i] = max(self.KOMA_QTY[i] - koma_count[i], 0)
+        self.position = position
+        self.csalines = position.csa_lines(side)
+        print("\n".join(self.csalines))
         return "\n".join(self.csalines) + "\n+"
 
     @staticmethod
@@ -59,47 +202,48 @@ class CsaConverter:
         if koma in KomaDetector.NARI_KOMA_NAMES:
             return KomaDetector.NARI_KOMA_NAMES.index(koma)
 
-    def __add_koma(self, koma, qty=1):
-        """駒の種類ごとの枚数を追加する"""
-        idx = CsaConverter.koma_index(koma)
-        self.koma_count[idx] = self.koma_count[idx] + qty
-
-    def __detect_koma(self):
-        """盤上の駒を検出する"""
-        for i in range(9):
-            csa = "P" + str(i + 1)
-            for j in range(9):
-                img = self.board_image.masume_box_image(i, j)
-                koma = self.komaDetector.find_koma(img)
-                csa = csa + koma
-                self.__add_koma(koma)
-            print(csa)
-            self.csalines.append(csa)
-
-    def __detect_half_mochigoma(self, is_for_sente):
-        """先手/後手どちらかの持駒を検出する"""
-        for i in range(7):
-            img = self.board_image.mochigoma_box_image(i, True)
-            (koma, qty) = self.mochiGomaDetector.find_koma_by_template(i, img)
-            if qty > 0:
-                csa = "P" + CsaConverter.teban_mark(is_for_sente) + ("00" + koma) * qty
-                self.__add_koma(koma, qty)
-                print(csa)
-                self.csalines.append(csa)
+    def __detect_koma(self, targets, komas):
+        """盤上の駒のうち、targetsのマス(左上から順に0〜80)を検出してkomasに入れる"""
+        targets = list(targets)
+        (results, scores) = self.__classify([(self.board_image, k) for k in targets])
+        for (k, koma) in zip(targets, results):
+            komas[k] = koma
+        if scores is not None:
+            board_scores = [None] * 81
+            for (k, score) in zip(targets, scores):
+                board_scores[k] = score
+            self.koma_scores = [board_scores[i * 9 : i * 9 + 9] for i in range(9)]
+        return komas
 
-    def __calc_rest_mochigoma(self, is_for_sente):
-        """残りの駒数を計算する"""
-        for i in range(1, 8):
-            qty = self.KOMA_QTY[i] - self.koma_count[i]
-            if qty > 0:
-                csa = (
-                    "P"
-                    + CsaConverter.teban_mark(is_for_sente)
-                    + ("00" + KomaDetector.KOMA_NAMES[i]) * qty
-                )
-                self.__add_koma(KomaDetector.KOMA_NAMES[i], qty)
-                print(csa)
-                self.csalines.append(csa)
+    def __classify(self, squares):
+        """(画像, マス)のリストの駒を判定して、(駒のリスト, 相関係数のリスト)を返す
+
+        correlation・modelでは全てのマスをまとめて判定する。相関係数はcorrelationの場合だけ"""
+        if self.classifier == "orb":
+            komas = []
+            for (board_image, k) in squares:
+                with tracer.stage("crop"):
+                    img = board_image.masume_box_image(k // 9, k % 9)
+                with tracer.stage("classify"):
+                    komas.append(self.komaDetector.find_koma(img))
+            return (komas, None)
+        with tracer.stage("crop"):
+            images = [
+                board_image.masume_box_image(k // 9, k % 9)
+                for (board_image, k) in squares
+            ]
+        with tracer.stage("classify"):
+            if self.classifier == "model":
+                return (self.komaDetector.find_komas_by_classifier(images), None)
+            results = self.komaDetector.find_komas_by_correlation(images)
+        return ([koma for (koma, _) in results], [score for (_, score) in results])
+
+    def __detect_mochigoma(self, targets, mochigomas):
+        """持ち駒のうち、targetsの種類(歩から飛の順に0〜6)の(駒, 枚数)を検出してmochigomasに入れる"""
+        for i in targets:
+            img = self.board_image.mochigoma_box_image(i, True)
+            mochigomas[i] = self.mochiGomaDetector.find_koma_by_template(i, img)
+        return mochigomas
 
     @staticmethod
     def teban_mark(is_for_sente):
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import contextlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+if __name__ == "__main__" or __package__ == "":
+    from usiengine import UsiEngine
+else:
+    from .usiengine import UsiEngine
+
+
+class UsiEnginePool:
+    """起動・isready済みのUSIプロトコル将棋エンジンを複数持っておき、スレッドごとに貸し出す
+
+    起動し直せなかったエンジンの枠にはNoneを置いておき、次に借りるときに起動し直す
+    (エンジンの数が減って、checkoutがずっと待たされることがないように)"""
+
+    # 空いているエンジンを待つ時間(秒)
+    CHECKOUT_TIMEOUT = 60
+
+    def __init__(
+        self,
+        engine_cmd,
+        size=1,
+        options=[],
+        timeout=3,
+        debug=False,
+        listener=None,
+        checkout_timeout=CHECKOUT_TIMEOUT,
+    ):
+        self.engine_cmd = engine_cmd
+        self.size = size
+        self.options = options
+        self.timeout = timeout
+        self.debug = debug
+        self.listener = listener
+        self.checkout_timeout = checkout_timeout
+        self.__idle = queue.Queue()
+        self.__engines = []
+        self.__lock = threading.Lock()
+        # エンジンの起動は別スレッドで並行して行う
+        # (イベントループ実行中のスレッドからでもプールを作れるように)
+        try:
+            with ThreadPoolExecutor(max_workers=size) as executor:
+                for usi in executor.map(lambda _: self.__spawn(), range(size)):
+                    self.__idle.put(usi)
+        except BaseException:
+            # 起動できなかったエンジンがあれば、起動できたエンジンも終了させる
+            # (プールを返せないので、呼び出し側では終了させられない)
+            self.quit()
+            raise
+
+    def __spawn(self):
+        """エンジンを起動してオプションを設定し、isreadyまで済ませる"""
+        usi = UsiEngine(
+            self.engine_cmd,
+            timeout=self.timeout,
+            debug=self.debug,
+            listener=self.listener,
+            new_loop=True,
+        )
+        for (option_name, option_value) in self.options:
+            usi.setoption(option_name, option_value)
+        usi.isready()
+        if not usi.is_alive() or usi.timed_out:
+            UsiEnginePool.__quit_engine(usi)
+            raise RuntimeError("engine not ready: " + self.engine_cmd)
+        with self.__lock:
+            self.__engines.append(usi)
+        return usi
+
+    def __discard(self, usi):
+        """エンジンを終了させてプールから外す"""
+        with self.__lock:
+            if usi in self.__engines:
+                self.__engines.remove(usi)
+        UsiEnginePool.__quit_engine(usi)
+
+    def checkout(self, timeout=None):
+        """空いているエンジンを借りる、timeout秒待っても空かなければTimeoutError"""
+        if timeout is None:
+            timeout = self.checkout_timeout
+        try:
+            usi = self.__idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("no idle engine in pool")
+        if usi is None:
+            # 前回起動し直せなかった枠、起動できなければ枠を戻してから例外を投げる
+            try:
+                usi = self.__spawn()
+            except BaseException:
+                self.__idle.put(None)
+                raise
+        return usi
+
+    def checkin(self, usi):
+        """借りたエンジンを返す、応答がなくなったエンジンは起動し直す
+
+        go/go mateの時間切れでは応答待ちの中でstopを送っているので、
+        それでも応答がなかった(timed_out)エンジンは止めずに起動し直す。
+        起動し直せなかった場合も例外は投げず、枠だけ戻しておいて次のcheckoutで起動し直す"""
+        if not usi.is_alive() or usi.timed_out:
+            self.__discard(usi)
+            try:
+                usi = self.__spawn()
+            except Exception:
+                usi = None
+        self.__idle.put(usi)
+
+    @contextlib.contextmanager
+    def engine(self, timeout=None):
+        """with文で使うためのcheckout/checkin"""
+        usi = self.checkout(timeout)
+        try:
+            yield usi
+        finally:
+            self.checkin(usi)
+
+    def quit(self):
+        """全エンジンを終了させる"""
+        with self.__lock:
+            engines = list(self.__engines)
+            self.__engines = []
+        if not engines:
+            return
+        # 起動時と同様に、終了も別スレッドで行う
+        with ThreadPoolExecutor(max_workers=len(engines)) as executor:
+            executor.map(UsiEnginePool.__quit_engine, engines)
+
+    @staticmethod
+    def __quit_engine(usi):
+        try:
+            usi.quit()
+        except (OSError, RuntimeError):
+            pass
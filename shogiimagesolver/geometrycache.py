@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import threading
+from collections import OrderedDict
+
+
+class GeometryCache:
+    """画像サイズ(幅, 高さ)ごとに、前回検出した盤の位置を保存しておくキャッシュ
+
+    同じ機種のスクリーンショットは盤の位置も同じなので、BoardImageは
+    保存された位置に線があるかだけを確認して、盤の検出を省略する"""
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # 位置は見つかったが、確認で線が見つからなかった回数
+        self.rejects = 0
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, size):
+        """保存されている盤の位置を返す、なければNone"""
+        with self.__lock:
+            geometry = self.__cache.get(size)
+            if geometry is not None:
+                self.__cache.move_to_end(size)
+            return geometry
+
+    def put(self, size, geometry):
+        """検出した盤の位置を保存する"""
+        if self.max_size <= 0:
+            return
+        with self.__lock:
+            self.__cache[size] = geometry
+            self.__cache.move_to_end(size)
+            while len(self.__cache) > self.max_size:
+                self.__cache.popitem(last=False)
+
+    def hit(self):
+        with self.__lock:
+            self.hits += 1
+
+    def miss(self, rejected=False):
+        with self.__lock:
+            self.misses += 1
+            if rejected:
+                self.rejects += 1
+
+    def stats(self):
+        """ヒット数・ミス数・確認で外れた数・件数を返す"""
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "rejects": self.rejects,
+                "size": len(self.__cache),
+            }
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+if __name__ == "__main__" or __package__ == "":
+    from lazyimport import lazy_import
+else:
+    from .lazyimport import lazy_import
+
+# numpy・Pillowは最初に使うときに読み込む
+np = lazy_import("numpy", globals(), "np")
+Image = lazy_import("PIL.Image", globals(), "Image")
+
+
+class ImageCache:
+    """スクリーンショットの内容から、以前の解析結果を引くキャッシュ
+
+    ファイル内容のハッシュ値による完全一致と、盤部分の縮小画像による見た目の一致の2段で探す"""
+
+    FINGERPRINT_SIZE = (64, 64)
+
+    def __init__(self, max_size=1024, max_diff=16, verify=True):
+        self.max_size = max_size
+        # 見た目が一致するとみなす、縮小画像の画素値の差の最大値
+        self.max_diff = max_diff
+        # 見た目の一致では、画像解析をやり直して同じ局面か確認する(詰み探索だけを省略する)
+        # Falseにすると駒の判定も省略するが、持ち駒の枚数や歩ととの違いのような
+        # 縮小画像では差が小さい変化を見落として、別の局面の結果を返すことがある
+        self.verify = verify
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.__cache = OrderedDict()
+        self.__keys = []
+        self.__fingerprints = None
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def content_hash(data):
+        """画像ファイルの内容のハッシュ値"""
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def fingerprint(trimmed_image):
+        """盤部分の画像(Pillow形式)をグレースケールで縮小したもの
+
+        縮小時に平均をとるので、JPEGのノイズ程度の違いは吸収される"""
+        img = trimmed_image.convert("L").resize(ImageCache.FINGERPRINT_SIZE, Image.BOX)
+        return np.asarray(img, dtype=np.int16).reshape(-1)
+
+    def get_exact(self, content_hash):
+        """内容が完全に一致する画像の結果を返す、なければNone"""
+        with self.__lock:
+            entry = self.__cache.get(content_hash)
+            if entry is None:
+                return None
+            self.__cache.move_to_end(content_hash)
+            self.exact_hits += 1
+            return entry[1]
+
+    def get_similar(self, fingerprint):
+        """見た目が一致する画像の結果を返す、なければNone"""
+        with self.__lock:
+            if not self.__cache:
+                self.misses += 1
+                return None
+            if self.__fingerprints is None:
+                self.__keys = list(self.__cache.keys())
+                self.__fingerprints = np.stack(
+                    [entry[0] for entry in self.__cache.values()]
+                )
+            diff = np.abs(self.__fingerprints - fingerprint).max(axis=1)
+            idx = int(np.argmin(diff))
+            if diff[idx] > self.max_diff:
+                self.misses += 1
+                return None
+            key = self.__keys[idx]
+            self.__cache.move_to_end(key)
+            self.similar_hits += 1
+            return self.__cache[key][1]
+
+    def reject_similar(self):
+        """見た目は一致したが、確認の結果は別の局面だった"""
+        with self.__lock:
+            self.similar_hits -= 1
+            self.misses += 1
+
+    def put(self, content_hash, fingerprint, value):
+        """画像の解析結果を保存する"""
+        if self.max_size <= 0:
+            return
+        with self.__lock:
+            self.__cache[content_hash] = (fingerprint, value)
+            self.__cache.move_to_end(content_hash)
+            while len(self.__cache) > self.max_size:
+                self.__cache.popitem(last=False)
+            self.__fingerprints = None
+
+    def stats(self):
+        """ヒット数・ミス数・件数を返す"""
+        with self.__lock:
+            return {
+                "exact_hits": self.exact_hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "size": len(self.__cache),
+            }
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+            self.__fingerprints = None
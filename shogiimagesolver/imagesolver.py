@@ -1,31 +1,85 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
-import glob
+import io
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 if __name__ == "__main__" or __package__ == "":
     from boardimage import BoardImage
     from csaconverter import CsaConverter
-    from usiengine import UsiEngine
+    from enginepool import UsiEnginePool
+    from matecache import MateCache
+    from imagecache import ImageCache
+    from geometrycache import GeometryCache
     from sfen2kif import Sfen2kif
-    from csa2sfen import Csa2Sfen
+    from instrument import tracer
+    from lazyimport import lazy_import
 else:
     from .boardimage import BoardImage
     from .csaconverter import CsaConverter
-    from .usiengine import UsiEngine
+    from .enginepool import UsiEnginePool
+    from .matecache import MateCache
+    from .imagecache import ImageCache
+    from .geometrycache import GeometryCache
     from .sfen2kif import Sfen2kif
-    from .csa2sfen import Csa2Sfen
+    from .instrument import tracer
+    from .lazyimport import lazy_import
+
+# asyncio・Pillowは最初に使うときに読み込む
+asyncio = lazy_import("asyncio", globals())
+Image = lazy_import("PIL.Image", globals(), "Image")
 
 
 class ImageSolver:
     """将棋アプリ画像を解析して次の一手/詰め手順を求める"""
 
     DEFAULT_ENGINE = "./YaneuraOu-mate"
+    # 1局面あたりの詰み探索の待ち時間(秒)
     MATE_WAIT = 5
+    # 最初の詰み探索の秒読み(秒)、Noneなら最初からMATE_WAIT秒探索する
+    MATE_FIRST_WAIT = 0.5
+    # 時間切れなら、秒読みを何倍にして探索し直すか
+    MATE_ESCALATION = 4
+    # 空いているエンジンを待つ時間(秒)、過ぎればTimeoutError
+    CHECKOUT_WAIT = 60
 
-    def __init__(self, engine=None, options=[]):
-        self.converter = CsaConverter()
+    def __init__(
+        self,
+        engine=None,
+        options=[],
+        pool_size=1,
+        mate_cache=None,
+        image_cache=None,
+        geometry_cache=None,
+        kif_file=False,
+        classifier="orb",
+        model_file=None,
+    ):
+        self.pool = None
+        # Trueなら、詰め手順をKIF形式の棋譜ファイルの内容(局面図付き)で返す
+        self.kif_file = kif_file
+        # 画像サイズごとの盤の位置のキャッシュ、Falseなら使わない
+        if geometry_cache is None:
+            geometry_cache = GeometryCache()
+        self.geometry_cache = geometry_cache
+        # 画像ごとの解析結果のキャッシュ、Falseなら使わない
+        if image_cache is None:
+            image_cache = ImageCache()
+        self.image_cache = image_cache
+        # 詰み探索結果のキャッシュ、Falseなら使わない
+        if mate_cache is None:
+            mate_cache = MateCache(db_file=os.environ.get("SHOGI_MATE_CACHE_DB"))
+        self.mate_cache = mate_cache
+        # 駒の判定器(サンプル画像の読み込みとOpenCVが必要)は最初に画像を解析するときに作る
+        # 盤上の駒の判定方法はCsaConverter.CLASSIFIERSのいずれか
+        self.classifier = classifier
+        self.model_file = model_file
+        self.__converter = None
+        # 画像解析は複数スレッドから同時に行わない
+        self.__converter_lock = threading.RLock()
         env_engine = os.environ.get("SHOGI_ENGINE")
         # 引数→環境変数→デフォルトの順
         if engine:
@@ -34,97 +88,273 @@ class ImageSolver:
             self.engine = env_engine
         else:
             self.engine = self.DEFAULT_ENGINE
-        self.usi = UsiEngine(
-            os.path.abspath(os.path.expanduser(self.engine)), debug=True
+        # エンジンはpool_size個起動してオプション設定・isreadyまで済ませておく
+        self.pool = UsiEnginePool(
+            os.path.abspath(os.path.expanduser(self.engine)),
+            size=pool_size,
+            options=options,
+            debug=True,
+            checkout_timeout=self.CHECKOUT_WAIT,
         )
-        for (option_name, option_value) in options:
-            self.usi.setoption(option_name, option_value)
+        # asyncio用: 画像解析と詰み探索を別スレッドで重ねて実行する
+        self.__recognize_executor = ThreadPoolExecutor(max_workers=1)
+        self.__engine_executor = ThreadPoolExecutor(max_workers=pool_size)
 
     def __del__(self):
         self.quit()
 
     def quit(self):
         """USIプロトコル対応将棋エンジンを終了させる"""
-        if self.usi:
-            self.usi.quit()
-            self.usi = None
+        if self.pool:
+            self.__recognize_executor.shutdown(wait=False)
+            self.__engine_executor.shutdown(wait=False)
+            self.pool.quit()
+            self.pool = None
+        if self.mate_cache:
+            self.mate_cache.close()
+
+    @property
+    def converter(self):
+        """画像解析用のCsaConverter、sfen形式の局面だけを扱う場合は作らない"""
+        if self.__converter is None:
+            with self.__converter_lock:
+                if self.__converter is None:
+                    self.__converter = CsaConverter(
+                        classifier=self.classifier, model_file=self.model_file
+                    )
+        return self.__converter
 
     def image_to_sfen(self, board_image):
         """将棋アプリ画像をsfen形式に変換"""
-        csa = self.converter.from_board_image(board_image)
+        with self.__converter_lock:
+            csa = self.converter.from_board_image(board_image)
+            position = self.converter.position
+        return self.__to_sfen(csa, position)
+
+    def images_to_sfen(self, board_images):
+        """複数の将棋アプリ画像をまとめてsfen形式に変換して、画像ごとに(sfen, csa)のリストを返す
+
+        classifierがcorrelation・modelなら、全ての画像の盤上のマスを1回でまとめて判定する"""
+        with self.__converter_lock:
+            results = self.converter.from_board_images(board_images)
+        return [self.__to_sfen(csa, position) for (csa, position) in results]
+
+    def image_to_sfen_incremental(
+        self, board_image, previous_board_image, previous_komas, previous_mochigomas
+    ):
+        """前回の画像と判定結果から、変わったマス・持ち駒だけ判定し直してsfen形式に変換
+
+        (sfen, csa, komas, mochigomas)を返すので、komas, mochigomasを次回に渡す"""
+        with self.__converter_lock:
+            csa = self.converter.from_board_image_incremental(
+                board_image, previous_board_image, previous_komas, previous_mochigomas
+            )
+            position = self.converter.position
+            komas = self.converter.komas
+            mochigomas = self.converter.mochigomas
+        (sfen, csa) = self.__to_sfen(csa, position)
+        return (sfen, csa, komas, mochigomas)
+
+    def __to_sfen(self, csa, position):
         print(csa)
-        csa2Sfen = Csa2Sfen.from_csa(csa)
-        sfen = csa2Sfen.sfen()
-        # parser = shogi.CSA.Parser.parse_str(csa)
-        # sfen = parser[0]["sfen"]
-        if sfen is None:
+        if position is None:
             print("解析NG")
             return (None, None)
+        # CSA形式の文字列を読み直さず、判定結果の局面から直接作る
+        with tracer.stage("csa2sfen"):
+            sfen = position.sfen()
+        # parser = shogi.CSA.Parser.parse_str(csa)
+        # sfen = parser[0]["sfen"]
         print(sfen)
         return (sfen, csa)
 
-    def mate_by_usi(self, sfen):
-        """USIプロトコル対応詰将棋エンジンで詰め手順を計算"""
-        usi = self.usi
-        usi.isready()
-        usi.position(sfen="sfen " + sfen)
-        mate_lines = usi.go_mate(self.MATE_WAIT * 1000)
+    def mate_by_usi(self, sfen, mate_wait=None):
+        """USIプロトコル対応詰将棋エンジンで詰め手順を計算
+
+        最初はMATE_FIRST_WAIT秒で探索し、時間切れならMATE_ESCALATION倍ずつ秒読みを延ばして
+        探索し直す。mate_wait秒(省略時はMATE_WAIT秒)経てばstopして、打ち切った結果を返す"""
+        if mate_wait is None:
+            mate_wait = self.MATE_WAIT
+        deadline = time.monotonic() + mate_wait
+        budget = self.MATE_FIRST_WAIT or mate_wait
+        with self.pool.engine() as usi:
+            usi.isready()
+            usi.position(sfen="sfen " + sfen)
+            while True:
+                remaining = max(deadline - time.monotonic(), 0)
+                byoyomi = min(budget, remaining)
+                mate_lines = usi.go_mate(
+                    max(int(byoyomi * 1000), 1), deadline=remaining
+                )
+                if (
+                    byoyomi >= remaining
+                    or usi.timed_out
+                    or not mate_lines
+                    or mate_lines[-1].strip() != "checkmate timeout"
+                ):
+                    break
+                budget *= self.MATE_ESCALATION
         return mate_lines
 
-    def solve_from_board_image(self, board_image):
+    def solve_from_board_image(self, board_image, mate_wait=None):
         """将棋盤イメージを元に解析"""
         (sfen, csa) = self.image_to_sfen(board_image)
         if sfen is None:
             return ("parse_NG", None, None)
-        mate_lines = self.mate_by_usi(sfen)
-        if not mate_lines[-1].startswith("checkmate"):
+        return self.solve_from_sfen(sfen, csa, mate_wait)
+
+    @staticmethod
+    def __is_reusable(result, mate_wait):
+        """キャッシュした結果を使えるか、待ち時間を指定された場合は時間切れの結果を使わない"""
+        return mate_wait is None or result != "timeout"
+
+    def solve_from_sfen(self, sfen, csa=None, mate_wait=None):
+        """sfen形式の局面を元に詰め手順を計算、mate_waitで詰み探索の待ち時間(秒)を指定できる"""
+        if self.mate_cache:
+            cached = self.mate_cache.get(sfen)
+            if cached is not None and ImageSolver.__is_reusable(cached[0], mate_wait):
+                (result, mate_line, kif) = cached
+                if result == "checkmate" and self.kif_file:
+                    kif = Sfen2kif.kif_file(sfen, mate_line)
+                return (kif if result == "checkmate" else result, sfen, csa)
+        mate_lines = self.mate_by_usi(sfen, mate_wait)
+        if not mate_lines or not mate_lines[-1].startswith("checkmate"):
             return ("solve_NG", sfen, csa)
         mate_line = mate_lines[-1][10:]
         if "nomate" in mate_line:
             print("不詰")
+            self.__put_mate_cache(sfen, "nomate", mate_line)
             return ("nomate", sfen, csa)
-        kif = Sfen2kif.parse_moves(sfen, mate_line)
+        if mate_line.strip() == "timeout":
+            print("時間切れ")
+            self.__put_mate_cache(sfen, "timeout", mate_line)
+            return ("timeout", sfen, csa)
+        with tracer.stage("kif"):
+            kif = Sfen2kif.parse_moves(sfen, mate_line)
         print(kif)
+        # キャッシュには常に1行の棋譜を保存する
+        self.__put_mate_cache(sfen, "checkmate", mate_line, kif)
+        if self.kif_file:
+            kif = Sfen2kif.kif_file(sfen, mate_line)
         return (kif, sfen, csa)
 
-    def solve_from_file(self, file_name):
-        """将棋盤イメージファイルを元に解析"""
-        board_image = BoardImage.from_file(file_name)
+    def __put_mate_cache(self, sfen, result, mate_line, kif=None):
+        if self.mate_cache:
+            self.mate_cache.put(sfen, result, mate_line, kif)
+
+    def solve_from_file(self, file_name, mate_wait=None):
+        """将棋盤イメージファイルを元に解析、mate_waitで詰み探索の待ち時間(秒)を指定できる"""
+        if self.image_cache:
+            with open(file_name, "rb") as f:
+                return self.solve_from_bytes(f.read(), mate_wait)
+        board_image = BoardImage.from_file(file_name, self.geometry_cache)
         if board_image is None or not board_image.is_board:
             return ("image_NG", None, None, None)
-        (result, sfen, csa) = self.solve_from_board_image(board_image)
+        (result, sfen, csa) = self.solve_from_board_image(board_image, mate_wait)
         img = board_image.trimmed_image()
         return (result, sfen, csa, img)
 
+    def solve_from_bytes(self, data, mate_wait=None):
+        """将棋盤イメージファイルの内容を元に解析"""
+        if not self.image_cache:
+            board_image = BoardImage.from_bytes(data, self.geometry_cache)
+            if not board_image.is_board:
+                return ("image_NG", None, None, None)
+            (result, sfen, csa) = self.solve_from_board_image(board_image, mate_wait)
+            return (result, sfen, csa, board_image.trimmed_image())
+        # 同じ内容の画像なら、盤の検出も含めて全て省略する
+        content_hash = ImageCache.content_hash(data)
+        cached = self.image_cache.get_exact(content_hash)
+        if cached is not None and ImageSolver.__is_reusable(cached[0], mate_wait):
+            (result, sfen, csa, box) = cached
+            img = Image.open(io.BytesIO(data)).crop(box)
+            return (result, sfen, csa, img)
+        board_image = BoardImage.from_bytes(data, self.geometry_cache)
+        if not board_image.is_board:
+            return ("image_NG", None, None, None)
+        img = board_image.trimmed_image()
+        fingerprint = ImageCache.fingerprint(img)
+        # 見た目が同じ画像なら、駒の判定を省略する
+        cached = self.image_cache.get_similar(fingerprint)
+        if cached is not None and not ImageSolver.__is_reusable(cached[0], mate_wait):
+            cached = None
+        if cached is not None and self.image_cache.verify:
+            # 確認する場合は、詰み探索だけを省略する
+            (sfen, csa) = self.image_to_sfen(board_image)
+            if sfen != cached[1]:
+                self.image_cache.reject_similar()
+                if sfen is None:
+                    (result, sfen, csa) = ("parse_NG", None, None)
+                else:
+                    (result, sfen, csa) = self.solve_from_sfen(sfen, csa, mate_wait)
+                cached = None
+        elif cached is None:
+            (result, sfen, csa) = self.solve_from_board_image(board_image, mate_wait)
+        if cached is not None:
+            (result, sfen, csa, _) = cached
+        if result != "solve_NG":
+            self.image_cache.put(
+                content_hash,
+                fingerprint,
+                (result, sfen, csa, board_image.trimmed_box()),
+            )
+        return (result, sfen, csa, img)
 
-if __name__ == "__main__":
-    imageSolver = ImageSolver(options=[("USI_HASH", 128)])
-    files = glob.glob("./**/testin/*.jpg")
-    total = 0
-    nomate_num = 0
-    for file_name in files:
-        (result, sfen, csa, img) = imageSolver.solve_from_file(file_name)
-        if result is None or sfen is None or img is None:
-            continue
-        basename_without_ext = os.path.splitext(os.path.basename(file_name))[0]
-        result_file_name = "./testout/result_" + basename_without_ext
-        img.save(result_file_name + ".png")
-        total = total + 1
-        if result == "nomate":
-            nomate_num = nomate_num + 1
-        summary = (
-            "image="
-            + file_name
-            + ", result="
-            + result
-            + "\nsfen="
-            + sfen
-            + "\ncsa:\n"
-            + csa
+    def __recognize(self, image):
+        """画像ファイル名/Pillow形式の画像/BoardImageを解析してsfen形式に変換"""
+        if isinstance(image, BoardImage):
+            board_image = image
+        elif isinstance(image, (str, os.PathLike)):
+            board_image = BoardImage.from_file(image, self.geometry_cache)
+        else:
+            board_image = BoardImage(image, self.geometry_cache)
+        if not board_image.is_board:
+            return (board_image, None, None)
+        (sfen, csa) = self.image_to_sfen(board_image)
+        return (board_image, sfen, csa)
+
+    async def solve(self, image, mate_wait=None):
+        """画像を解析して詰め手順を求める(asyncio用)
+
+        imageは画像ファイル名、Pillow形式の画像、BoardImageのいずれか。
+        画像解析と詰み探索はそれぞれ別スレッドで行うので、イベントループは止まらない"""
+        loop = asyncio.get_running_loop()
+        (board_image, sfen, csa) = await loop.run_in_executor(
+            self.__recognize_executor, self.__recognize, image
+        )
+        if not board_image.is_board:
+            return ("image_NG", None, None, None)
+        img = board_image.trimmed_image()
+        if sfen is None:
+            return ("parse_NG", None, None, img)
+        (result, sfen, csa) = await loop.run_in_executor(
+            self.__engine_executor, self.solve_from_sfen, sfen, csa, mate_wait
         )
-        print(summary)
-        with open(result_file_name + ".txt", "w", encoding="utf-8") as f:
-            f.write(summary)
-    imageSolver.quit()
-    print("nomate/total = " + str(nomate_num) + "/" + str(total))
-    exit(0)
+        return (result, sfen, csa, img)
+
+    async def solve_many(self, images, concurrency=None):
+        """複数の画像を解析して、終わったものから(image, 結果)を返す(asyncio用)
+
+        詰み探索中に次の画像の解析を進めるため、既定ではエンジン数+1件ずつ並行して処理する"""
+        if concurrency is None:
+            concurrency = self.pool.size + 1
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def solve_one(image):
+            async with semaphore:
+                return (image, await self.solve(image))
+
+        tasks = [asyncio.ensure_future(solve_one(image)) for image in images]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+if __name__ == "__main__":
+    # 大量の画像をまとめて解析する場合はbatch.pyを使う
+    from batch import main
+
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import json
+import threading
+import time
+from collections import deque
+
+if __name__ == "__main__" or __package__ == "":
+    from lazyimport import lazy_import
+else:
+    from .lazyimport import lazy_import
+
+# numpyは最初に使うときに読み込む
+np = lazy_import("numpy", globals(), "np")
+
+"""画像解析・詰み探索の処理段階ごとの時間計測
+
+    from shogiimagesolver.instrument import tracer
+    tracer.enable()
+    ...
+    print(tracer.stats.dump())
+
+無効時(既定)のstage()は何もしないコンテキストマネージャを返すだけなので、計測の負荷はほぼない"""
+
+
+class _NullStage:
+    """無効時のstage()が返す、何もしないコンテキストマネージャ"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """with文の範囲の経過時間を計測してTracerに記録する"""
+
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageStats:
+    """処理段階ごとの回数・経過時間を集計する
+
+    パーセンタイルは処理段階ごとに直近max_samples件の計測値から求める"""
+
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, max_samples=100000):
+        self.max_samples = max_samples
+        self.__counts = {}
+        self.__totals = {}
+        self.__samples = {}
+        self.__lock = threading.Lock()
+
+    def add(self, name, elapsed):
+        with self.__lock:
+            if name not in self.__counts:
+                self.__counts[name] = 0
+                self.__totals[name] = 0.0
+                self.__samples[name] = deque(maxlen=self.max_samples)
+            self.__counts[name] += 1
+            self.__totals[name] += elapsed
+            self.__samples[name].append(elapsed)
+
+    def summary(self):
+        """処理段階ごとの回数・合計・平均・p50/p95/p99・最大(秒)を返す"""
+        with self.__lock:
+            names = list(self.__counts.keys())
+            counts = dict(self.__counts)
+            totals = dict(self.__totals)
+            samples = {name: np.array(self.__samples[name]) for name in names}
+        result = {}
+        for name in names:
+            values = samples[name]
+            stage = {
+                "count": counts[name],
+                "total": totals[name],
+                "mean": totals[name] / counts[name],
+                "max": float(values.max()),
+            }
+            for (p, value) in zip(
+                self.PERCENTILES, np.percentile(values, self.PERCENTILES)
+            ):
+                stage["p%d" % p] = float(value)
+            result[name] = stage
+        return result
+
+    def dump(self, file_name=None):
+        """集計結果をJSON形式で返す、file_nameを指定した場合はファイルにも出力する"""
+        text = json.dumps(self.summary(), indent=2)
+        if file_name:
+            with open(file_name, "w", encoding="utf-8") as f:
+                f.write(text)
+        return text
+
+    def clear(self):
+        with self.__lock:
+            self.__counts.clear()
+            self.__totals.clear()
+            self.__samples.clear()
+
+
+class Tracer:
+    """処理段階ごとの時間計測の有効/無効と、計測結果の通知先を管理する"""
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = StageStats()
+        self.__listeners = []
+
+    def enable(self, listener=None):
+        """計測を有効にする、listenerは計測ごとにlistener(処理段階, 秒)で呼ばれる"""
+        if listener is not None:
+            self.add_listener(listener)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def add_listener(self, listener):
+        self.__listeners = self.__listeners + [listener]
+
+    def remove_listener(self, listener):
+        self.__listeners = [x for x in self.__listeners if x is not listener]
+
+    def stage(self, name):
+        """with文の範囲を処理段階nameとして計測する"""
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def record(self, name, elapsed):
+        """計測結果を集計して通知する"""
+        self.stats.add(name, elapsed)
+        for listener in self.__listeners:
+            listener(name, elapsed)
+
+
+# パッケージ全体で共有する計測器
+tracer = Tracer()
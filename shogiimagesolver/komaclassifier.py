@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import argparse
+import glob
+import json
+import os
+import random
+import time
+
+# python -m shogiimagesolver.komaclassifier でも実行できるように、パッケージ内かどうかで判定する
+if __package__:
+    from .komadetector import KomaDetector
+    from .lazyimport import lazy_import
+else:
+    from komadetector import KomaDetector
+    from lazyimport import lazy_import
+
+# numpy・OpenCVは最初に使うときに読み込む
+np = lazy_import("numpy", globals(), "np")
+cv2 = lazy_import("cv2", globals())
+
+"""盤上のマスの画像から駒を判定する、学習済みの分類器(縮小画像の主成分分析+最近傍重心)
+
+samplecollector.pyが出力した駒ごとのディレクトリ(testout/bankoma*)の画像で学習し、.npzに保存する。
+    python -m shogiimagesolver.komaclassifier testout
+学習に使わなかった画像で、KomaDetector(ORB)と正解率・速度を比較した結果も出力する"""
+
+
+class KomaClassifier:
+    """縮小したマスの画像を主成分空間に射影し、最も近い駒の重心を判定結果とする
+
+    射影と重心との距離の計算は1つの行列(特徴量の次元×駒の種類)にまとめてあるので、
+    81マス分をまとめて1回の行列積で判定できる"""
+
+    # 特徴量にする縮小画像のサイズ
+    FEATURE_SIZE = (24, 24)
+    # 主成分の数
+    N_COMPONENTS = 32
+    # 学習用の画像のディレクトリ名の接頭辞(samplecollector.pyの出力)
+    SAMPLE_DIR_PREFIX = "bankoma"
+    # 学習した分類器の保存先(環境変数SHOGI_KOMA_MODELで変更できる)
+    DEFAULT_FILE = os.path.join(KomaDetector.TEACHER_IMG_DIR, "komaclassifier.npz")
+
+    def __init__(self, labels, mean, components, centroids):
+        # 駒の種類(CSA形式の" * ", "+FU", "-RY"など)
+        self.labels = [str(label) for label in labels]
+        # 特徴量の平均、主成分(1行1主成分)、駒の種類ごとの主成分空間での重心
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        # 重心との距離の2乗は |x|^2 - 2 f·(W c) + (2 m·(W c) + |c|^2) (f: 特徴量, m: 平均, W: 主成分)
+        # |x|^2は駒の種類によらないので、f·(W c)の行列積と定数項だけで最も近い重心がわかる
+        projection = self.components.T @ self.centroids.T
+        self.__projection = np.ascontiguousarray(-2.0 * projection)
+        self.__bias = 2.0 * (self.mean @ projection) + (self.centroids**2).sum(axis=1)
+
+    @staticmethod
+    def features(images):
+        """マスの画像を縮小して、画像ごとに平均0・ノルム1に正規化した特徴量の行列にする"""
+        resized = [
+            cv2.resize(img, KomaClassifier.FEATURE_SIZE, interpolation=cv2.INTER_AREA)
+            for img in images
+        ]
+        return KomaDetector.normalize_images(resized)
+
+    @staticmethod
+    def fit(images, labels, n_components=N_COMPONENTS):
+        """マスの画像と駒の種類から学習する"""
+        if len(images) == 0:
+            raise ValueError("no training images")
+        features = KomaClassifier.features(images)
+        mean = features.mean(axis=0)
+        centered = features - mean
+        # 主成分は特異値分解で求める
+        n_components = min(n_components, centered.shape[0], centered.shape[1])
+        (_, _, vt) = np.linalg.svd(centered, full_matrices=False)
+        components = vt[:n_components]
+        projected = centered @ components.T
+        label_names = sorted(set(labels))
+        label_index = {label: i for (i, label) in enumerate(label_names)}
+        indices = np.array([label_index[label] for label in labels])
+        centroids = np.zeros((len(label_names), n_components), dtype=np.float32)
+        for i in range(len(label_names)):
+            centroids[i] = projected[indices == i].mean(axis=0)
+        return KomaClassifier(label_names, mean, components, centroids)
+
+    def predict(self, images):
+        """複数のマスの画像を、1回の行列積でまとめて判定して駒の種類のリストを返す"""
+        if len(images) == 0:
+            return []
+        scores = KomaClassifier.features(images) @ self.__projection + self.__bias
+        return [self.labels[i] for i in np.argmin(scores, axis=1)]
+
+    def save(self, file_name):
+        """.npzファイルに保存する"""
+        np.savez_compressed(
+            file_name,
+            labels=np.array(self.labels),
+            mean=self.mean,
+            components=self.components,
+            centroids=self.centroids,
+            feature_size=np.array(self.FEATURE_SIZE),
+        )
+
+    @staticmethod
+    def load(file_name):
+        """save()で保存したファイルを読み込む"""
+        with np.load(file_name) as data:
+            if tuple(data["feature_size"]) != KomaClassifier.FEATURE_SIZE:
+                raise ValueError("feature size mismatch: " + file_name)
+            return KomaClassifier(
+                data["labels"], data["mean"], data["components"], data["centroids"]
+            )
+
+    @staticmethod
+    def label_from_dir(dir_name):
+        """samplecollector.pyの出力ディレクトリ名(bankomaPFU, bankoma-FU, bankomabanなど)を駒の種類にする"""
+        name = os.path.basename(os.path.normpath(dir_name))
+        name = name[len(KomaClassifier.SAMPLE_DIR_PREFIX) :]
+        if name == "ban":
+            return KomaDetector.KOMA_NAMES[0]
+        if name.startswith("P"):
+            return "+" + name[1:]
+        return name
+
+    @staticmethod
+    def load_samples(root):
+        """rootの下の駒ごとのディレクトリから、(画像, 駒の種類)のリストを読み込む"""
+        samples = []
+        pattern = os.path.join(root, KomaClassifier.SAMPLE_DIR_PREFIX + "*")
+        for dir_name in sorted(glob.glob(pattern)):
+            if not os.path.isdir(dir_name):
+                continue
+            label = KomaClassifier.label_from_dir(dir_name)
+            for fname in sorted(glob.glob(os.path.join(dir_name, "*.png"))):
+                img = cv2.imread(fname, cv2.IMREAD_GRAYSCALE)
+                if img is not None and img.size > 0:
+                    samples.append((img, label))
+        return samples
+
+
+def split_samples(samples, test_ratio, seed=0):
+    """駒の種類ごとにtest_ratioの割合を評価用に分ける(1枚しかない種類は全て学習用)"""
+    rng = random.Random(seed)
+    by_label = {}
+    for sample in samples:
+        by_label.setdefault(sample[1], []).append(sample)
+    (train, test) = ([], [])
+    for label in sorted(by_label):
+        group = by_label[label]
+        rng.shuffle(group)
+        n_test = int(len(group) * test_ratio)
+        test.extend(group[:n_test])
+        train.extend(group[n_test:])
+    return (train, test)
+
+
+def evaluate(detector, samples, board_size=81):
+    """評価用の画像で、分類器とORB(KomaDetector.find_koma)の正解率と処理速度を求める
+
+    分類器はCsaConverter(classifier="model")と同じく、空きマスの判定をしてから盤面1つ分ずつまとめて判定する"""
+    images = [img for (img, _) in samples]
+    labels = [label for (_, label) in samples]
+    start = time.perf_counter()
+    predicted = []
+    for i in range(0, len(images), board_size):
+        predicted.extend(detector.find_komas_by_classifier(images[i : i + board_size]))
+    classifier_sec = time.perf_counter() - start
+    start = time.perf_counter()
+    detected = [detector.find_koma(img) for img in images]
+    detector_sec = time.perf_counter() - start
+    count = len(samples)
+    return {
+        "squares": count,
+        "classifier": {
+            "accuracy": sum(1 for (a, b) in zip(predicted, labels) if a == b) / count,
+            "sec_per_square": classifier_sec / count,
+            "squares_per_sec": count / classifier_sec if classifier_sec else None,
+        },
+        "orb": {
+            "accuracy": sum(1 for (a, b) in zip(detected, labels) if a == b) / count,
+            "sec_per_square": detector_sec / count,
+            "squares_per_sec": count / detector_sec if detector_sec else None,
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="駒ごとのディレクトリの画像で盤上の駒の分類器を学習し、ORBと比較する")
+    parser.add_argument(
+        "root", nargs="?", default="testout", help="bankoma*ディレクトリのある場所"
+    )
+    parser.add_argument(
+        "--out",
+        default=os.environ.get("SHOGI_KOMA_MODEL", KomaClassifier.DEFAULT_FILE),
+        help="学習した分類器の保存先",
+    )
+    parser.add_argument(
+        "--components", type=int, default=KomaClassifier.N_COMPONENTS, help="主成分の数"
+    )
+    parser.add_argument(
+        "--test-ratio", type=float, default=0.2, help="評価用にする画像の割合(0なら評価しない)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--sample-dir",
+        default=KomaDetector.TEACHER_IMG_DIR,
+        help="比較するKomaDetectorのサンプル画像のディレクトリ",
+    )
+    args = parser.parse_args(argv)
+    samples = KomaClassifier.load_samples(args.root)
+    if not samples:
+        parser.error("no samples in " + os.path.join(args.root, "bankoma*"))
+    (train, test) = split_samples(samples, args.test_ratio, args.seed)
+    start = time.perf_counter()
+    classifier = KomaClassifier.fit(
+        [img for (img, _) in train], [label for (_, label) in train], args.components
+    )
+    report = {
+        "train_squares": len(train),
+        "labels": len(classifier.labels),
+        "components": len(classifier.components),
+        "train_sec": time.perf_counter() - start,
+    }
+    classifier.save(args.out)
+    report["model_file"] = args.out
+    report["model_bytes"] = os.path.getsize(args.out)
+    if test:
+        detector = KomaDetector(sample_dir=args.sample_dir, koma_classifier=classifier)
+        report["test"] = evaluate(detector, test)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
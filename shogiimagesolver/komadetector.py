@@ -2,7 +2,17 @@
 # -*- coding: UTF-8 -*-
 
 import os
-import cv2
+
+if __name__ == "__main__" or __package__ == "":
+    from teachercache import TeacherCache
+    from lazyimport import lazy_import
+else:
+    from .teachercache import TeacherCache
+    from .lazyimport import lazy_import
+
+# numpy・OpenCVは最初に使うときに読み込む
+np = lazy_import("numpy", globals(), "np")
+cv2 = lazy_import("cv2", globals())
 
 
 class KomaDetector:
@@ -10,13 +20,44 @@ class KomaDetector:
     TEACHER_IMG_DIR = "bankoma"
     KOMA_NAMES = [" * ", "FU", "KY", "KE", "GI", "KI", "KA", "HI", "OU"]
     NARI_KOMA_NAMES = ["", "TO", "NY", "NK", "NG", "", "UM", "RY"]
+    # 空きマスの判定に使う縮小画像のサイズ
+    EMPTY_CHECK_SIZE = (20, 20)
+    # 空きマスとみなす、縮小画像の画素値の標準偏差の上限(Noneなら空きマスの判定をしない)
+    EMPTY_THRESHOLD = 8.0
+    # 空きマスとみなす、空きマスのサンプル画像(00.png)との平均画素値の差の上限
+    EMPTY_MEAN_TOLERANCE = 40.0
+    # 相関係数で判定する場合の画像サイズ、縮小してぼかすことで位置ずれの影響を減らす
+    CORRELATION_SIZE = (32, 32)
 
-    def __init__(self, sample_dir=TEACHER_IMG_DIR):
+    def __init__(
+        self,
+        sample_dir=TEACHER_IMG_DIR,
+        use_cache=True,
+        empty_threshold=EMPTY_THRESHOLD,
+        validate_empty=False,
+        koma_classifier=None,
+    ):
         self.sample_dir = sample_dir
+        # 学習済みの分類器(KomaClassifier)、find_komas_by_classifierで使う
+        self.koma_classifier = koma_classifier
+        self.empty_threshold = empty_threshold
+        # 空きマスの判定結果を、全サンプル画像との比較結果と突き合わせる
+        self.validate_empty = validate_empty
+        self.empty_checked = 0
+        self.empty_hits = 0
+        self.empty_disagreements = []
         # self.__detector = cv2.AKAZE_create()
         self.__detector = cv2.ORB_create()
         self.__bf = cv2.BFMatcher(cv2.NORM_HAMMING)
-        self.__teacher_list = self.__prepare_teacher()
+        if use_cache:
+            self.__teacher_list = self.__load_teacher()
+        else:
+            self.__teacher_list = self.__prepare_teacher()
+        self.__prepare_teacher_index()
+        self.__prepare_teacher_matrix()
+        # 空きマスのサンプル画像の平均画素値
+        empty_img = self.__teacher_list[0][2]
+        self.__empty_mean = None if empty_img is None else float(empty_img.mean())
 
     def __prepare_teacher(self):
         """比較用のサンプル画像を読み込んで解析しておく"""
@@ -37,6 +78,110 @@ class KomaDetector:
             teacher_list.append(("-" + self.NARI_KOMA_NAMES[i], tmp_des, resized_img))
         return teacher_list
 
+    def __load_teacher(self):
+        """比較用のデータをキャッシュから読み込む、キャッシュが使えなければ作り直して保存する"""
+        cache = TeacherCache(
+            self.sample_dir,
+            "komadetector",
+            (self.IMG_SIZE, TeacherCache.orb_params(self.__detector)),
+        )
+
+        def unpack(data):
+            des_list = TeacherCache.unpack_descriptors(data["des"], data["des_counts"])
+            teacher_list = []
+            for i in range(len(data["names"])):
+                img = data["images"][i] if data["has_image"][i] else None
+                teacher_list.append((str(data["names"][i]), des_list[i], img))
+            return teacher_list
+
+        teacher_list = cache.load(unpack)
+        if teacher_list is not None:
+            return teacher_list
+        teacher_list = self.__prepare_teacher()
+        (des, des_counts) = TeacherCache.pack_descriptors(
+            [des for (_, des, _) in teacher_list]
+        )
+        images = np.zeros(
+            (len(teacher_list), self.IMG_SIZE[1], self.IMG_SIZE[0]), dtype=np.uint8
+        )
+        for i in range(len(teacher_list)):
+            if teacher_list[i][2] is not None:
+                images[i] = teacher_list[i][2]
+        cache.save(
+            {
+                "names": np.array([name for (name, _, _) in teacher_list]),
+                "des": des,
+                "des_counts": des_counts,
+                "images": images,
+                "has_image": np.array(
+                    [img is not None for (_, _, img) in teacher_list]
+                ),
+            }
+        )
+        return teacher_list
+
+    def __prepare_teacher_index(self):
+        """全サンプル画像の特徴量を1つの行列にまとめておく"""
+        des_list = []
+        offsets = []
+        indices = []
+        offset = 0
+        for i in range(len(self.__teacher_list)):
+            (_, des, _) = self.__teacher_list[i]
+            if des is None:
+                continue
+            des_list.append(des)
+            offsets.append(offset)
+            indices.append(i)
+            offset += len(des)
+        if des_list:
+            self.__teacher_des = np.ascontiguousarray(np.vstack(des_list))
+            # ハミング距離を行列積で求めるため、ビット単位に展開して転置しておく
+            teacher_bits = np.unpackbits(self.__teacher_des, axis=1).astype(np.float32)
+            self.__teacher_bits = np.ascontiguousarray(teacher_bits.T)
+            self.__teacher_bit_count = teacher_bits.sum(axis=1)
+        else:
+            self.__teacher_des = None
+        # 行列中の各サンプル画像の開始位置と、teacher_list中の位置
+        self.__teacher_offsets = np.array(offsets, dtype=np.intp)
+        self.__teacher_indices = np.array(indices, dtype=np.intp)
+
+    @staticmethod
+    def normalize_images(images):
+        """画像ごとに平均0・ノルム1に正規化して、1行1画像の行列にする"""
+        mat = np.asarray(images, dtype=np.float32).reshape(len(images), -1)
+        mat = mat - mat.mean(axis=1, keepdims=True)
+        norm = np.linalg.norm(mat, axis=1, keepdims=True)
+        # 濃淡のない画像はどのサンプル画像とも相関0にする
+        return np.divide(mat, norm, out=np.zeros_like(mat), where=norm > 0)
+
+    def correlation_image(self, img):
+        """相関係数で判定するために縮小してぼかした画像"""
+        img = cv2.resize(img, self.CORRELATION_SIZE, interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(img, (3, 3), 0)
+
+    def __prepare_teacher_matrix(self):
+        """相関係数で判定するため、全サンプル画像を正規化して転置した行列にしておく"""
+        images = np.zeros(
+            (
+                len(self.__teacher_list),
+                self.CORRELATION_SIZE[1],
+                self.CORRELATION_SIZE[0],
+            ),
+            dtype=np.uint8,
+        )
+        has_image = np.zeros(len(self.__teacher_list), dtype=bool)
+        for i in range(len(self.__teacher_list)):
+            img = self.__teacher_list[i][2]
+            if img is not None:
+                images[i] = self.correlation_image(img)
+                has_image[i] = True
+        self.__teacher_matrix = np.ascontiguousarray(
+            KomaDetector.normalize_images(images).T
+        )
+        # 画像のないサンプルは選ばれないようにする
+        self.__teacher_missing = ~has_image
+
     def read_detect(self, fname):
         """駒画像をグレースケールで読み込んで同一サイズに揃えて解析"""
         img = cv2.imread(fname, cv2.IMREAD_GRAYSCALE)
@@ -52,6 +197,134 @@ class KomaDetector:
 
     def find_koma(self, cv2greyimg):
         """OpenCVグレースケール画像を元に、どの駒か判定する"""
+        if cv2greyimg is None or cv2greyimg.size == 0:
+            return self.KOMA_NAMES[0]
+        if self.empty_threshold is None:
+            return self.find_koma_by_index(cv2greyimg)
+        self.empty_checked += 1
+        (is_empty, score) = self.is_empty(cv2greyimg)
+        if is_empty:
+            self.empty_hits += 1
+        if not self.validate_empty:
+            if is_empty:
+                return self.KOMA_NAMES[0]
+            return self.find_koma_by_index(cv2greyimg)
+        koma = self.find_koma_by_index(cv2greyimg)
+        if is_empty != (koma == self.KOMA_NAMES[0]):
+            self.empty_disagreements.append((score, is_empty, koma))
+        return koma
+
+    def empty_score(self, cv2greyimg):
+        """縮小画像の(画素値の標準偏差, 平均画素値)、駒があれば文字の線で標準偏差が大きくなる"""
+        small = cv2.resize(
+            cv2greyimg, self.EMPTY_CHECK_SIZE, interpolation=cv2.INTER_AREA
+        )
+        (mean, stddev) = cv2.meanStdDev(small)
+        return (float(stddev[0, 0]), float(mean[0, 0]))
+
+    def is_empty(self, cv2greyimg):
+        """特徴量を求めずに空きマスかどうか判定して、(空きマスか, 標準偏差)を返す"""
+        (score, mean) = self.empty_score(cv2greyimg)
+        if score > self.empty_threshold:
+            return (False, score)
+        if (
+            self.__empty_mean is not None
+            and abs(mean - self.__empty_mean) > self.EMPTY_MEAN_TOLERANCE
+        ):
+            return (False, score)
+        return (True, score)
+
+    def empty_report(self):
+        """空きマスの判定の件数と、validate_empty時の全サンプル画像との比較結果との不一致"""
+        return {
+            "checked": self.empty_checked,
+            "empty": self.empty_hits,
+            "disagreements": list(self.empty_disagreements),
+        }
+
+    def find_koma_by_index(self, cv2greyimg):
+        """OpenCVグレースケール画像を元に、全サンプル画像の特徴量とまとめて比較してどの駒か判定する"""
+        (target_des, resized_img) = self.resize_detect(cv2greyimg)
+        if target_des is None or self.__teacher_des is None:
+            return self.KOMA_NAMES[0]
+        # 全サンプル画像の特徴量とのハミング距離を一度に求める
+        target_bits = np.unpackbits(target_des, axis=1).astype(np.float32)
+        dist = (
+            target_bits.sum(axis=1)[:, None]
+            + self.__teacher_bit_count[None, :]
+            - 2 * (target_bits @ self.__teacher_bits)
+        )
+        # サンプル画像ごとに最も近い特徴量の距離を求めて平均する
+        min_dist = np.minimum.reduceat(dist, self.__teacher_offsets, axis=1)
+        ret = np.full(len(self.__teacher_list), 9999.0)
+        ret[self.__teacher_indices] = min_dist.sum(axis=0, dtype=np.float64) / len(
+            target_des
+        )
+        # 最も似ている画像を見つける
+        koma_index = int(np.argmin(ret))
+        return self.check_koma_direction(resized_img, koma_index)
+
+    def find_koma_by_correlation(self, cv2greyimg):
+        """OpenCVグレースケール画像を元に、サンプル画像との相関係数でどの駒か判定して(駒, 相関係数)を返す"""
+        return self.find_komas_by_correlation([cv2greyimg])[0]
+
+    def find_komas_by_correlation(self, cv2greyimgs):
+        """複数のマスの画像を、全サンプル画像との相関係数の行列積1回で判定する
+
+        駒の種類と向きを同時に判定して、マスごとに(駒, 相関係数)を返す。
+        空きマスの判定で空きマスとなったマスの相関係数はNone"""
+        results = [(self.KOMA_NAMES[0], None)] * len(cv2greyimgs)
+        targets = []
+        resized = []
+        for (i, img) in enumerate(cv2greyimgs):
+            if img is None or img.size == 0:
+                continue
+            if self.empty_threshold is not None:
+                self.empty_checked += 1
+                if self.is_empty(img)[0]:
+                    self.empty_hits += 1
+                    continue
+            targets.append(i)
+            resized.append(self.correlation_image(img))
+        if not targets:
+            return results
+        scores = KomaDetector.normalize_images(resized) @ self.__teacher_matrix
+        scores[:, self.__teacher_missing] = -1.0
+        best = np.argmax(scores, axis=1)
+        for (k, i) in enumerate(targets):
+            koma_index = int(best[k])
+            if koma_index == 0:
+                name = self.KOMA_NAMES[0]
+            else:
+                name = self.__teacher_list[koma_index][0]
+            results[i] = (name, float(scores[k, koma_index]))
+        return results
+
+    def find_komas_by_classifier(self, cv2greyimgs):
+        """複数のマスの画像を、学習済みの分類器(KomaClassifier)の行列積1回でまとめて判定する
+
+        空きマスの判定で空きマスとなったマスは分類器で判定しない
+        (濃淡のない画像を正規化すると、JPEGのノイズが強調されて誤判定しやすい)"""
+        if self.koma_classifier is None:
+            raise ValueError("koma_classifier is not set")
+        results = [self.KOMA_NAMES[0]] * len(cv2greyimgs)
+        targets = []
+        for (i, img) in enumerate(cv2greyimgs):
+            if img is None or img.size == 0:
+                continue
+            if self.empty_threshold is not None:
+                self.empty_checked += 1
+                if self.is_empty(img)[0]:
+                    self.empty_hits += 1
+                    continue
+            targets.append(i)
+        komas = self.koma_classifier.predict([cv2greyimgs[i] for i in targets])
+        for (i, koma) in zip(targets, komas):
+            results[i] = koma
+        return results
+
+    def find_koma_by_bfmatcher(self, cv2greyimg):
+        """OpenCVグレースケール画像を元に、サンプル画像ごとに特徴量を比較してどの駒か判定する"""
         if cv2greyimg is None:
             self.KOMA_NAMES[0]
         (target_des, resized_img) = self.resize_detect(cv2greyimg)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import importlib
+
+"""読み込みに時間がかかるモジュール(OpenCV・numpy・Pillow・asyncio)を、最初に使うときに読み込む
+
+    cv2 = lazy_import("cv2", globals())
+    np = lazy_import("numpy", globals(), "np")
+
+sfen形式の局面・棋譜だけを扱う場合や、パッケージをimportしただけの場合は読み込まない。
+最初に属性を参照したときに読み込み、呼び出し元のモジュールの変数を本物のモジュールに置き換えるので、
+それ以降の参照は通常のimportと同じ速さになる"""
+
+
+class LazyModule:
+    """最初に属性を参照したときに、モジュールを読み込んで呼び出し元の変数を置き換える"""
+
+    __slots__ = ("_name", "_namespace", "_alias", "_module")
+
+    def __init__(self, name, namespace, alias):
+        self._name = name
+        self._namespace = namespace
+        self._alias = alias
+        self._module = None
+
+    def _load(self):
+        """モジュールを読み込む(読み込み済みならそのまま返す)"""
+        module = self._module
+        if module is None:
+            module = importlib.import_module(self._name)
+            self._module = module
+            if self._namespace.get(self._alias) is self:
+                self._namespace[self._alias] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return "<lazy module '%s' (%s)>" % (self._name, state)
+
+
+def lazy_import(name, namespace, alias=None):
+    """nameのモジュールを、namespace(呼び出し元のglobals())のalias(省略時はname)として遅延読み込みする"""
+    alias = alias or name
+    module = LazyModule(name, namespace, alias)
+    namespace[alias] = module
+    return module
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MateCache:
+    """局面(sfen)ごとの詰み探索結果を保存しておくキャッシュ
+
+    プロセス内のLRUと、db_fileを指定した場合はSQLiteの2段構成。
+    値は(結果, 詰み手順, 棋譜)で、結果は"checkmate"/"nomate"/"timeout"のいずれか"""
+
+    def __init__(self, max_size=1024, ttl=None, db_file=None, db_max_size=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_max_size = db_max_size
+        self.hits = 0
+        self.misses = 0
+        self.__cache = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__db = None
+        if db_file:
+            self.__db = sqlite3.connect(db_file, check_same_thread=False)
+            self.__db.execute(
+                "CREATE TABLE IF NOT EXISTS mate_result ("
+                "sfen TEXT PRIMARY KEY, result TEXT, mate_line TEXT, kif TEXT,"
+                " created REAL)"
+            )
+            self.__db.execute(
+                "CREATE INDEX IF NOT EXISTS mate_result_created"
+                " ON mate_result (created)"
+            )
+            self.__db.commit()
+
+    @staticmethod
+    def normalize(sfen):
+        """手数を除いた、盤面・手番・持ち駒の部分をキーにする"""
+        return " ".join(sfen.split()[:3])
+
+    def __is_expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, sfen):
+        """保存されている(結果, 詰み手順, 棋譜)を返す、なければNone"""
+        key = MateCache.normalize(sfen)
+        with self.__lock:
+            entry = self.__cache.get(key)
+            if entry is not None:
+                if not self.__is_expired(entry[0]):
+                    self.__cache.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.__cache[key]
+            if self.__db is not None:
+                row = self.__db.execute(
+                    "SELECT result, mate_line, kif, created FROM mate_result"
+                    " WHERE sfen = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None and not self.__is_expired(row[3]):
+                    value = (row[0], row[1], row[2])
+                    self.__put_memory(key, value, row[3])
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return None
+
+    def put(self, sfen, result, mate_line, kif=None):
+        """詰み探索の結果を保存する"""
+        key = MateCache.normalize(sfen)
+        value = (result, mate_line, kif)
+        created = time.time()
+        with self.__lock:
+            self.__put_memory(key, value, created)
+            if self.__db is not None:
+                self.__db.execute(
+                    "INSERT OR REPLACE INTO mate_result VALUES (?, ?, ?, ?, ?)",
+                    (key, result, mate_line, kif, created),
+                )
+                if self.db_max_size is not None:
+                    # 古いものから消す
+                    self.__db.execute(
+                        "DELETE FROM mate_result WHERE sfen IN ("
+                        "SELECT sfen FROM mate_result ORDER BY created DESC"
+                        " LIMIT -1 OFFSET ?)",
+                        (self.db_max_size,),
+                    )
+                self.__db.commit()
+
+    def __put_memory(self, key, value, created):
+        if self.max_size <= 0:
+            return
+        self.__cache[key] = (created, value)
+        self.__cache.move_to_end(key)
+        while len(self.__cache) > self.max_size:
+            self.__cache.popitem(last=False)
+
+    def stats(self):
+        """ヒット数・ミス数・件数を返す"""
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.__cache),
+            }
+
+    def clear(self):
+        with self.__lock:
+            self.__cache.clear()
+            if self.__db is not None:
+                self.__db.execute("DELETE FROM mate_result")
+                self.__db.commit()
+
+    def close(self):
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.close()
+                self.__db = None
@@ -1,24 +1,106 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
-import cv2
 import os
 import glob
 
+if __name__ == "__main__" or __package__ == "":
+    from komadetector import KomaDetector
+    from teachercache import TeacherCache
+    from lazyimport import lazy_import
+else:
+    from .komadetector import KomaDetector
+    from .teachercache import TeacherCache
+    from .lazyimport import lazy_import
+
+# OpenCV・numpyは最初に使うときに読み込む
+cv2 = lazy_import("cv2", globals())
+np = lazy_import("numpy", globals(), "np")
+
 
 class MochigomaDetector:
     IMG_SIZE = (115, 120)
     TEACHER_IMG_DIR = "mochigoma_sente"
     KOMA_NAMES = ["FU", "KY", "KE", "GI", "KI", "KA", "HI"]
     KOMA_QTY = [18, 4, 4, 4, 4, 2, 2]
+    # 枚数の数字を探す範囲の、リサイズ後の画像の幅・高さに対する開始位置の割合
+    # Noneなら画像全体を探す。(0.45, 0.45)などで右下だけ探すと速くなるが、
+    # 数字がその範囲に収まるかは合成画像でしか確かめていないので、実際の画像で確かめてから使う
+    NUM_REGION = None
+    # 枚数の数字とみなす相関係数の下限
+    NUM_MIN_SCORE = 0.5
+    # 画像全体の相関係数がこれ未満なら、ORBの特徴点が見つかるかどうかで駒があるか確かめる
+    PRESENCE_MIN_SCORE = 0.8
 
-    def __init__(self, sample_dir=TEACHER_IMG_DIR):
+    def __init__(
+        self, sample_dir=TEACHER_IMG_DIR, use_cache=True, num_region=NUM_REGION
+    ):
         self.sample_dir = sample_dir
+        self.num_region = num_region
         # self.__detector = cv2.AKAZE_create()
         self.__detector = cv2.ORB_create()
         self.__bf = cv2.BFMatcher(cv2.NORM_HAMMING)
-        self.__teacher_list = self.__prepare_teacher()
-        self.__num_image_list = self.__prepare_num_images()
+        if use_cache:
+            (self.__teacher_list, self.__num_image_list) = self.__load_teacher()
+        else:
+            self.__teacher_list = self.__prepare_teacher()
+            self.__num_image_list = self.__prepare_num_images()
+        # ORBの特徴点は画像の端からedgeThreshold以内には見つからず、FASTは周囲(半径3)の画素との差が
+        # fastThresholdを超える点を探すので、その範囲の画素値の幅がしきい値以下なら特徴点は見つからない
+        # (縮小した画像でも画素値の幅は広がらない。補間で隣の画素を使う分、1画素広く調べる)
+        # 逆に、画素値の幅がしきい値を超えても特徴点が見つかるとは限らない
+        self.__presence_border = max(self.__detector.getEdgeThreshold() - 4, 0)
+        self.__presence_threshold = self.__detector.getFastThreshold()
+        self.__prepare_teacher_matrices()
+        self.__prepare_num_spectra()
+
+    def __load_teacher(self):
+        """比較用のデータをキャッシュから読み込む、キャッシュが使えなければ作り直して保存する"""
+        cache = TeacherCache(
+            self.sample_dir,
+            "mochigomadetector",
+            (self.IMG_SIZE, TeacherCache.orb_params(self.__detector)),
+        )
+
+        def unpack(data):
+            des_list = TeacherCache.unpack_descriptors(data["des"], data["des_counts"])
+            teacher_list = [[] for _ in range(len(self.KOMA_NAMES))]
+            for i in range(len(data["koma_idx"])):
+                teacher_list[data["koma_idx"][i]].append(
+                    (int(data["num"][i]), des_list[i], data["images"][i])
+                )
+            num_image_list = [
+                data["num_image%d" % i] for i in range(int(data["num_image_qty"]))
+            ]
+            return (teacher_list, num_image_list)
+
+        cached = cache.load(unpack)
+        if cached is not None:
+            return cached
+        teacher_list = self.__prepare_teacher()
+        num_image_list = self.__prepare_num_images()
+        entries = [
+            (i, num, des, img)
+            for i in range(len(teacher_list))
+            for (num, des, img) in teacher_list[i]
+        ]
+        (des, des_counts) = TeacherCache.pack_descriptors(
+            [des for (_, _, des, _) in entries]
+        )
+        arrays = {
+            "koma_idx": np.array([i for (i, _, _, _) in entries], dtype=np.int32),
+            "num": np.array([num for (_, num, _, _) in entries], dtype=np.int32),
+            "des": des,
+            "des_counts": des_counts,
+            "images": np.array(
+                [img for (_, _, _, img) in entries], dtype=np.uint8
+            ).reshape((len(entries), self.IMG_SIZE[1], self.IMG_SIZE[0])),
+            "num_image_qty": np.array(len(num_image_list)),
+        }
+        for i in range(len(num_image_list)):
+            arrays["num_image%d" % i] = num_image_list[i]
+        cache.save(arrays)
+        return (teacher_list, num_image_list)
 
     def __prepare_num_images(self):
         num_image_list = []
@@ -68,38 +150,127 @@ class MochigomaDetector:
         (target_kp, target_des) = self.__detector.detectAndCompute(img, None)
         return (target_des, img)
 
+    def __prepare_teacher_matrices(self):
+        """駒の種類ごとに、サンプル画像を正規化した行列と枚数の配列にしておく
+
+        同じサイズの画像どうしのTM_CCOEFF_NORMEDは相関係数なので、行列とベクトルの積で求められる"""
+        self.__teacher_matrices = []
+        for one_koma_list in self.__teacher_list:
+            if not one_koma_list:
+                self.__teacher_matrices.append((None, None))
+                continue
+            matrix = KomaDetector.normalize_images(
+                [img for (_, _, img) in one_koma_list]
+            )
+            nums = [num for (num, _, _) in one_koma_list]
+            self.__teacher_matrices.append((matrix, nums))
+
+    def __prepare_num_spectra(self):
+        """枚数の数字のサンプル画像を、数字を探す範囲の相関をFFTでまとめて求められるように準備する
+
+        同じサイズのサンプル画像ごとに、平均0・ノルム1にした画像のフーリエ変換を1つの配列に重ねておく"""
+        (width, height) = self.IMG_SIZE
+        groups = {}
+        for (i, num_image) in enumerate(self.__num_image_list):
+            (th, tw) = num_image.shape
+            if th > height or tw > width:
+                # 画像より大きいサンプル画像は使わない
+                continue
+            groups.setdefault((th, tw), []).append(i)
+        self.__num_spectra = []
+        for ((th, tw), indices) in groups.items():
+            # 数字を探す範囲、サンプル画像より小さくならないようにする
+            (left, top) = (0, 0)
+            if self.num_region is not None:
+                top = min(int(height * self.num_region[1]), height - th)
+                left = min(int(width * self.num_region[0]), width - tw)
+            fft_size = (
+                cv2.getOptimalDFTSize(height - top),
+                cv2.getOptimalDFTSize(width - left),
+            )
+            templates = np.zeros((len(indices),) + fft_size, dtype=np.float32)
+            templates[:, :th, :tw] = KomaDetector.normalize_images(
+                [self.__num_image_list[i] for i in indices]
+            ).reshape(len(indices), th, tw)
+            spectra = np.conj(np.fft.rfft2(templates))
+            self.__num_spectra.append(
+                ((top, left), (th, tw), fft_size, np.array(indices), spectra)
+            )
+
+    def has_koma(self, resized_img):
+        """リサイズ後の画像にORBの特徴点が見つかりうるかを、画素値の幅で判定する
+
+        Falseなら特徴点は見つからない(駒はない)が、Trueでも特徴点が見つかるとは限らない"""
+        border = self.__presence_border
+        (height, width) = resized_img.shape[:2]
+        if border * 2 >= min(height, width):
+            return True
+        region = resized_img[border : height - border, border : width - border]
+        return int(region.max()) - int(region.min()) > self.__presence_threshold
+
     def __find_koma_type_by_templete(self, mochigoma_idx, cv2greyimg):
         # 画像をリサイズ
-        (target_des, resized_img) = self.resize_detect(cv2greyimg)
-        if target_des is None:
+        resized_img = cv2.resize(cv2greyimg, self.IMG_SIZE)
+        # ORBの特徴点が見つからない画像は0枚とする
+        if not self.has_koma(resized_img):
             return (0, resized_img)
-        qty = 0
-        max_res = 0.0
-        # 画像全体のテンプレートマッチングで最も似ている画像を見つける
-        for (num, des, img) in self.__teacher_list[mochigoma_idx]:
-            try:
-                res = cv2.matchTemplate(img, resized_img, cv2.TM_CCOEFF_NORMED)
-                if res > max_res:
-                    max_res = res
-                    qty = num
-            except cv2.error:
-                continue
-        return (qty, resized_img)
+        (matrix, nums) = self.__teacher_matrices[mochigoma_idx]
+        if matrix is None:
+            return (0, resized_img)
+        # 画像全体の相関係数で最も似ている画像を見つける(相関係数が正のものに限る)
+        scores = matrix @ KomaDetector.normalize_images([resized_img])[0]
+        best = int(np.argmax(scores))
+        if scores[best] <= 0.0 or nums[best] == 0:
+            return (0, resized_img)
+        # 似ている度合いが低ければ、特徴点が見つかるか確かめる
+        if scores[best] < self.PRESENCE_MIN_SCORE:
+            (target_kp, target_des) = self.__detector.detectAndCompute(
+                resized_img, None
+            )
+            if target_des is None:
+                return (0, resized_img)
+        return (nums[best], resized_img)
 
     def __find_koma_qty_by_template(self, resized_img):
-        qty = 1
-        max_res = 0.5
-        num_idx = 1
-        for num_image in self.__num_image_list:
-            try:
-                num_idx += 1
-                res = cv2.matchTemplate(num_image, resized_img, cv2.TM_CCOEFF_NORMED)
-                if res.max() > max_res:
-                    max_res = res.max()
-                    qty = num_idx
-            except cv2.error:
-                continue
-        return qty
+        """全ての数字のサンプル画像との相関係数(TM_CCOEFF_NORMED)をまとめて求めて枚数を判定する"""
+        scores = self.num_scores(resized_img)
+        if len(scores) == 0:
+            return 1
+        # 同じ相関係数なら、先(枚数が少ない方)のサンプル画像を採用する
+        best = int(np.argmax(scores))
+        if scores[best] > self.NUM_MIN_SCORE:
+            return best + 2
+        return 1
+
+    def num_scores(self, resized_img):
+        """数字のサンプル画像(num2.png〜)ごとの、num_regionの範囲内での相関係数の最大値"""
+        scores = np.full(len(self.__num_image_list), -np.inf)
+        for ((top, left), (th, tw), fft_size, indices, spectra) in self.__num_spectra:
+            region = resized_img[top:, left:].astype(np.float32)
+            (height, width) = region.shape
+            # 全てのサンプル画像との相互相関を、1回の逆フーリエ変換で求める
+            spectrum = np.fft.rfft2(region, fft_size)
+            correlations = np.fft.irfft2(spectrum[None] * spectra, fft_size)[
+                :, : height - th + 1, : width - tw + 1
+            ]
+            # 各位置の窓内の画素値の標準偏差(×画素数の平方根)を積分画像で求める
+            (sums, square_sums) = cv2.integral2(region, sdepth=cv2.CV_64F)[:2]
+            window_sum = (
+                sums[th:, tw:] - sums[:-th, tw:] - sums[th:, :-tw] + sums[:-th, :-tw]
+            )
+            window_square_sum = (
+                square_sums[th:, tw:]
+                - square_sums[:-th, tw:]
+                - square_sums[th:, :-tw]
+                + square_sums[:-th, :-tw]
+            )
+            variance = window_square_sum - window_sum * window_sum / (th * tw)
+            # 画素値が一様な窓の相関係数は0とする(OpenCVと同じ)
+            flat = variance < 1.0
+            deviation = np.sqrt(np.where(flat, 1.0, variance))
+            group_scores = np.where(flat, 0.0, correlations / deviation)
+            scores[indices] = group_scores.reshape(len(indices), -1).max(axis=1)
+        return scores
 
     def find_koma(self, mochigoma_idx, cv2greyimg):
         """OpenCVグレースケール画像を元に、どの駒か判定する"""
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+
+class Position:
+    """盤面81マスと先手・後手の持ち駒の枚数を配列で持つ局面
+
+    盤上の駒は先手の駒を正、後手の駒を負の数で表し、空きマスは0とする。
+    数の絶対値は歩〜玉が1〜8、成駒は元の駒の数にPROMOTEDを足した値。
+    sfen形式・CSA形式の文字列は、必要なときに配列から作る"""
+
+    __slots__ = ("board", "hands", "teban")
+
+    KOMA_NAMES = [" * ", "FU", "KY", "KE", "GI", "KI", "KA", "HI", "OU"]
+    NARI_KOMA_NAMES = ["", "TO", "NY", "NK", "NG", "", "UM", "RY"]
+    SFEN_KOMA = ["", "P", "L", "N", "S", "G", "B", "R", "K"]
+    TEBAN = ["b", "w"]
+    TEBAN_MARK = ["+", "-"]
+    PROMOTED = 8
+
+    # CSA形式の駒("+FU", "-RY", " * "など)・sfen形式の駒と数の対応表
+    CSA_CODES = {KOMA_NAMES[0]: 0}
+    SFEN_NAMES = {0: ""}
+    for i in range(1, 9):
+        CSA_CODES["+" + KOMA_NAMES[i]] = i
+        CSA_CODES["-" + KOMA_NAMES[i]] = -i
+        SFEN_NAMES[i] = SFEN_KOMA[i]
+        SFEN_NAMES[-i] = SFEN_KOMA[i].lower()
+    for i in [1, 2, 3, 4, 6, 7]:
+        CSA_CODES["+" + NARI_KOMA_NAMES[i]] = i + PROMOTED
+        CSA_CODES["-" + NARI_KOMA_NAMES[i]] = -(i + PROMOTED)
+        SFEN_NAMES[i + PROMOTED] = "+" + SFEN_KOMA[i]
+        SFEN_NAMES[-(i + PROMOTED)] = "+" + SFEN_KOMA[i].lower()
+    del i
+    CSA_NAMES = {code: name for (name, code) in CSA_CODES.items()}
+    SFEN_CODES = {name: code for (code, name) in SFEN_NAMES.items() if code != 0}
+    # 持ち駒の種類("FU"など)と数の対応表
+    KIND_CODES = {name: code for (code, name) in enumerate(KOMA_NAMES) if code > 0}
+
+    def __init__(self, teban=0):
+        # 左上(9一)から右へ、1段ずつ順に81マス
+        self.board = [0] * 81
+        # 先手・後手それぞれ、駒の数ごとの枚数
+        self.hands = [[0] * 9, [0] * 9]
+        # 0なら先手番、1なら後手番
+        self.teban = teban
+
+    @staticmethod
+    def from_sfen(sfen):
+        """sfen形式の局面から作る(手数は無視する)"""
+        fields = sfen.split()
+        try:
+            position = Position(
+                Position.TEBAN.index(fields[1]) if len(fields) > 1 else 0
+            )
+            k = 0
+            promoted = ""
+            for c in fields[0]:
+                if c.isdigit():
+                    k += int(c)
+                elif c == "+":
+                    promoted = c
+                elif c != "/":
+                    position.board[k] = Position.SFEN_CODES[promoted + c]
+                    promoted = ""
+                    k += 1
+            qty = 0
+            for c in fields[2] if len(fields) > 2 else "-":
+                if c == "-":
+                    break
+                if c.isdigit():
+                    qty = qty * 10 + int(c)
+                    continue
+                side = 0 if c.isupper() else 1
+                position.hands[side][Position.SFEN_CODES[c.upper()]] += qty or 1
+                qty = 0
+        except (KeyError, IndexError, ValueError):
+            raise ValueError("invalid sfen: " + sfen)
+        return position
+
+    @staticmethod
+    def kind(code):
+        """盤上の駒の数から、成る前の駒の種類(1〜8)を返す"""
+        code = abs(code)
+        return code - Position.PROMOTED if code > Position.PROMOTED else code
+
+    def koma_count(self):
+        """盤上と両者の持ち駒を合わせた、駒の種類ごとの枚数"""
+        count = [0] * 9
+        for code in self.board:
+            if code:
+                count[Position.kind(code)] += 1
+        for hand in self.hands:
+            for i in range(1, 9):
+                count[i] += hand[i]
+        return count
+
+    def sfen(self):
+        """sfen形式の局面(手数は1)"""
+        rows = []
+        for dan in range(9):
+            row = ""
+            blank = 0
+            for code in self.board[dan * 9 : dan * 9 + 9]:
+                if code == 0:
+                    blank += 1
+                    continue
+                if blank:
+                    row += str(blank)
+                    blank = 0
+                row += self.SFEN_NAMES[code]
+            if blank:
+                row += str(blank)
+            rows.append(row)
+        hands = ""
+        for side in range(2):
+            for i in range(1, 9):
+                qty = self.hands[side][i]
+                if qty > 1:
+                    hands += str(qty)
+                if qty >= 1:
+                    hands += (
+                        self.SFEN_KOMA[i] if side == 0 else self.SFEN_KOMA[i].lower()
+                    )
+        return (
+            "/".join(rows) + " " + self.TEBAN[self.teban] + " " + (hands or "-") + " 1"
+        )
+
+    def csa_lines(self, hand_first=0):
+        """CSA形式の局面の行(手番の行を除く)、持ち駒はhand_first側(0なら先手)から出力する"""
+        lines = []
+        for dan in range(9):
+            lines.append(
+                "P"
+                + str(dan + 1)
+                + "".join(
+                    self.CSA_NAMES[code] for code in self.board[dan * 9 : dan * 9 + 9]
+                )
+            )
+        for side in (hand_first, 1 - hand_first):
+            for i in range(1, 9):
+                qty = self.hands[side][i]
+                if qty > 0:
+                    lines.append(
+                        "P" + self.TEBAN_MARK[side] + ("00" + self.KOMA_NAMES[i]) * qty
+                    )
+        return lines
+
+    def csa(self, hand_first=0):
+        """CSA形式の局面"""
+        return (
+            "\n".join(self.csa_lines(hand_first)) + "\n" + self.TEBAN_MARK[self.teban]
+        )
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import argparse
+import contextlib
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# python -m shogiimagesolver.serve でも実行できるように、パッケージ内かどうかで判定する
+if __package__:
+    from .boardimage import BoardImage
+    from .csaconverter import CsaConverter
+    from .imagecache import ImageCache
+    from .imagesolver import ImageSolver
+    from .instrument import StageStats
+    from .synthetic import SyntheticBoard, random_sfen
+else:
+    from boardimage import BoardImage
+    from csaconverter import CsaConverter
+    from imagecache import ImageCache
+    from imagesolver import ImageSolver
+    from instrument import StageStats
+    from synthetic import SyntheticBoard, random_sfen
+
+"""画像解析・詰み探索をHTTPで受け付けるローカルサーバー
+
+    python -m shogiimagesolver.serve --port 8080 --engines 2
+    curl --data-binary @screenshot.jpg http://localhost:8080/solve
+    curl -d '{"sfen": "..."}' http://localhost:8080/sfen
+    curl http://localhost:8080/stats"""
+
+# 詰み探索の結果以外にImageSolverが返す結果
+STATUSES = ["nomate", "timeout", "solve_NG", "parse_NG", "image_NG"]
+
+
+class Busy(Exception):
+    """処理待ちの要求が多すぎて受け付けられない"""
+
+
+class _ImageRequest:
+    __slots__ = ("data", "mate_wait", "future", "queued")
+
+    def __init__(self, data, mate_wait):
+        self.data = data
+        self.mate_wait = mate_wait
+        self.future = Future()
+        self.queued = time.perf_counter()
+
+
+class SolverService:
+    """ImageSolver(駒の判定器・エンジン)を起動したままにして、画像・sfenの要求を処理する
+
+    画像の要求はキューに入れ、解析用のスレッドが最大batch_size件をまとめて取り出して
+    解析する(同じ内容の画像は1回だけ解析し、solverのclassifierがcorrelation・modelなら
+    全ての画像の盤上のマスを1回でまとめて判定する)。詰み探索はエンジンの数だけのスレッドで行う。
+    処理中の要求がmax_pending件を超えるとBusyを投げる"""
+
+    def __init__(self, solver, max_pending=64, batch_size=8, batch_wait=0.005):
+        self.solver = solver
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        # 1件目を取り出してから、続く要求を待つ秒数
+        self.batch_wait = batch_wait
+        self.stats = StageStats(max_samples=10000)
+        self.pending = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.__lock = threading.Lock()
+        self.__queue = queue.Queue(maxsize=max_pending)
+        self.__engine_executor = ThreadPoolExecutor(max_workers=solver.pool.size)
+        self.__thread = threading.Thread(
+            target=self.__run, name="recognizer", daemon=True
+        )
+        self.__thread.start()
+
+    def warmup(self, count=1):
+        """合成画像を解析して、初回の解析だけ遅くならないようにする"""
+        synthetic_board = SyntheticBoard()
+        rng = random.Random(0)
+        for _ in range(count):
+            data = synthetic_board.render_jpeg(random_sfen(rng))
+            board_image = BoardImage.from_bytes(data, self.solver.geometry_cache)
+            self.solver.image_to_sfen(board_image)
+
+    def __acquire(self):
+        with self.__lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise Busy()
+            self.pending += 1
+
+    def __release(self, _future=None):
+        with self.__lock:
+            self.pending -= 1
+
+    def submit_image(self, data, mate_wait=None):
+        """画像ファイルの内容を解析・詰み探索して、(結果, sfen, csa, 盤の範囲)のFutureを返す"""
+        self.__acquire()
+        request = _ImageRequest(data, mate_wait)
+        request.future.add_done_callback(self.__release)
+        start = request.queued
+        request.future.add_done_callback(
+            lambda _: self.stats.add("image", time.perf_counter() - start)
+        )
+        self.__queue.put_nowait(request)
+        return request.future
+
+    def submit_sfen(self, sfen, mate_wait=None):
+        """sfen形式の局面を詰み探索して、(結果, sfen, csa, None)のFutureを返す"""
+        self.__acquire()
+        start = time.perf_counter()
+        future = self.__engine_executor.submit(self.__solve_sfen, sfen, None, mate_wait)
+        future.add_done_callback(self.__release)
+        future.add_done_callback(
+            lambda _: self.stats.add("sfen", time.perf_counter() - start)
+        )
+        return future
+
+    def __solve_sfen(self, sfen, csa, mate_wait, box=None):
+        (result, sfen, csa) = self.solver.solve_from_sfen(sfen, csa, mate_wait)
+        return (result, sfen, csa, box)
+
+    def __next_batch(self):
+        """キューから最大batch_size件の要求を取り出す"""
+        batch = [self.__queue.get()]
+        deadline = time.perf_counter() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    batch.append(self.__queue.get(timeout=remaining))
+                else:
+                    batch.append(self.__queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+            start = time.perf_counter()
+            for request in batch:
+                self.stats.add("queue_wait", start - request.queued)
+            with self.__lock:
+                self.batches += 1
+                self.batched_requests += len(batch)
+            # 同じ内容の画像は1回だけ解析する
+            groups = {}
+            for request in batch:
+                groups.setdefault(ImageCache.content_hash(request.data), []).append(
+                    request
+                )
+            self.__recognize(list(groups.values()))
+            self.stats.add("recognize_batch", time.perf_counter() - start)
+
+    def __board_image(self, requests):
+        """画像を読み込んで盤の位置を求める、失敗すれば要求に例外・image_NGを返してNone"""
+        try:
+            board_image = BoardImage.from_bytes(
+                requests[0].data, self.solver.geometry_cache
+            )
+        except OSError:
+            # 画像として読み込めない
+            board_image = None
+        except Exception as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return None
+        if board_image is None or not board_image.is_board:
+            for request in requests:
+                request.future.set_result(("image_NG", None, None, None))
+            return None
+        return board_image
+
+    def __recognize(self, groups):
+        """同じ内容の画像の要求ごとのリストを受け取り、全ての画像の盤上の駒をまとめて判定する"""
+        targets = []
+        for requests in groups:
+            board_image = self.__board_image(requests)
+            if board_image is not None:
+                targets.append((requests, board_image))
+        if not targets:
+            return
+        try:
+            results = self.solver.images_to_sfen(
+                [board_image for (_, board_image) in targets]
+            )
+        except Exception as e:
+            for (requests, _) in targets:
+                for request in requests:
+                    request.future.set_exception(e)
+            return
+        for ((requests, board_image), (sfen, csa)) in zip(targets, results):
+            box = board_image.trimmed_box()
+            for request in requests:
+                if sfen is None:
+                    request.future.set_result(("parse_NG", None, None, box))
+                else:
+                    self.__engine_executor.submit(
+                        self.__chain, request.future, sfen, csa, request.mate_wait, box
+                    )
+
+    def __chain(self, future, sfen, csa, mate_wait, box):
+        try:
+            future.set_result(self.__solve_sfen(sfen, csa, mate_wait, box))
+        except Exception as e:
+            future.set_exception(e)
+
+    def snapshot(self):
+        """キューの長さ・処理中の要求数・処理時間のパーセンタイルなどを返す"""
+        with self.__lock:
+            result = {
+                "queue_depth": self.__queue.qsize(),
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_requests / self.batches
+                if self.batches
+                else 0.0,
+            }
+        result["latency"] = self.stats.summary()
+        for (name, cache) in [
+            ("geometry_cache", self.solver.geometry_cache),
+            ("mate_cache", self.solver.mate_cache),
+        ]:
+            if cache:
+                result[name] = cache.stats()
+        return result
+
+    def quit(self):
+        self.__engine_executor.shutdown(wait=False)
+        self.solver.quit()
+
+
+def to_json(result):
+    """(結果, sfen, csa, 盤の範囲)をレスポンス用の辞書にする"""
+    (result, sfen, csa, box) = result
+    if result in STATUSES:
+        (status, kif) = (result, None)
+    else:
+        (status, kif) = ("checkmate", result)
+    return {
+        "result": status,
+        "kif": kif,
+        "sfen": sfen,
+        "csa": csa,
+        "box": list(box) if box is not None else None,
+    }
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """POST /solve(画像), POST /sfen(JSON), GET /stats, GET /health を受け付ける"""
+
+    # 受け付ける画像の大きさの上限
+    MAX_BODY = 20 * 1024 * 1024
+    # 結果を待つ秒数の上限
+    RESULT_TIMEOUT = 120
+    service = None
+    quiet = False
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def __send_json(self, code, body, headers=()):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/stats":
+            self.__send_json(200, self.service.snapshot())
+        elif path == "/health":
+            self.__send_json(200, {"status": "ok"})
+        else:
+            self.__send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ("/solve", "/sfen"):
+            self.__send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            self.__send_json(400, {"error": "empty body"})
+            return
+        if length > self.MAX_BODY:
+            self.__send_json(413, {"error": "body too large"})
+            return
+        body = self.rfile.read(length)
+        query = parse_qs(url.query)
+        try:
+            mate_wait = query.get("mate_wait", [None])[0]
+            if url.path == "/sfen":
+                params = json.loads(body.decode("utf-8"))
+                sfen = params["sfen"]
+                mate_wait = params.get("mate_wait", mate_wait)
+            mate_wait = float(mate_wait) if mate_wait is not None else None
+        except (ValueError, KeyError, TypeError) as e:
+            self.__send_json(400, {"error": "bad request: " + str(e)})
+            return
+        try:
+            if url.path == "/sfen":
+                future = self.service.submit_sfen(sfen, mate_wait)
+            else:
+                future = self.service.submit_image(body, mate_wait)
+        except Busy:
+            self.__send_json(503, {"error": "busy"}, [("Retry-After", "1")])
+            return
+        try:
+            result = future.result(timeout=self.RESULT_TIMEOUT)
+        except Exception as e:
+            self.__send_json(500, {"error": repr(e)})
+            return
+        self.__send_json(200, to_json(result))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="画像解析・詰み探索をHTTPで受け付けるローカルサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--engines", type=int, default=1, help="起動するエンジンの数")
+    parser.add_argument("--engine", help="詰将棋エンジンのパス")
+    parser.add_argument("--hash", type=int, default=128, help="エンジンのUSI_HASH")
+    parser.add_argument(
+        "--max-pending", type=int, default=64, help="処理中の要求数の上限(超えると503)"
+    )
+    parser.add_argument("--batch-size", type=int, default=8, help="まとめて解析する画像の数の上限")
+    parser.add_argument("--batch-wait", type=float, default=0.005, help="まとめる要求を待つ秒数")
+    parser.add_argument(
+        "--classifier",
+        choices=CsaConverter.CLASSIFIERS,
+        default="orb",
+        help="盤上の駒の判定方法(correlation・modelはまとめた画像のマスを1回で判定する)",
+    )
+    parser.add_argument("--model", help="modelで使う学習済みの分類器(komaclassifier.pyで作ったファイル)")
+    parser.add_argument("--quiet", action="store_true", help="途中経過を出力しない")
+    args = parser.parse_args(argv)
+    redirect = open(os.devnull, "w") if args.quiet else sys.stdout
+    try:
+        with contextlib.redirect_stdout(redirect):
+            solver = ImageSolver(
+                engine=args.engine,
+                options=[("USI_HASH", args.hash)],
+                pool_size=args.engines,
+                image_cache=False,
+                classifier=args.classifier,
+                model_file=args.model,
+            )
+            service = SolverService(
+                solver, args.max_pending, args.batch_size, args.batch_wait
+            )
+            service.warmup()
+            RequestHandler.service = service
+            RequestHandler.quiet = args.quiet
+            server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+            print("listening on http://%s:%d" % server.server_address, file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+                service.quit()
+    finally:
+        if args.quiet:
+            redirect.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
-import shogi
+if __name__ == "__main__" or __package__ == "":
+    from position import Position
+else:
+    from .position import Position
 
 SUJI_NAMES = [
     "",
@@ -31,58 +34,140 @@ DAN1 = 97  # ord("a")
 
 TEBAN = ["▲", "△"]
 
+# 駒の数(Position)ごとの駒の名前、成駒は1文字(python-shogiのjapanese_symbolと同じ)
+KOMA_NAMES = ["", "歩", "香", "桂", "銀", "金", "角", "飛", "玉"]
+KOMA_NAMES += ["と", "杏", "圭", "全", "", "馬", "龍"]
+# KIF形式の棋譜ファイルの指し手での駒の名前
+KIF_KOMA_NAMES = KOMA_NAMES[:9] + ["と", "成香", "成桂", "成銀", "", "馬", "龍"]
+# KIF形式の棋譜ファイルの局面図での駒の名前
+BOD_KOMA_NAMES = ["・"] + KOMA_NAMES[1:]
+# 持ち駒の枚数の漢数字
+KANJI_NUMBERS = ["", "", "二", "三", "四", "五", "六", "七", "八", "九", "十"]
+KANJI_NUMBERS += ["十" + n for n in ["一", "二", "三", "四", "五", "六", "七", "八"]]
+
+# USI形式のマス("7g"など)ごとの、盤面の配列の位置・名前("７七")・KIFの移動元("77")
+SQUARE_INDEX = {}
+SQUARE_NAMES = {}
+SQUARE_NUMBERS = {}
+for suji in range(1, 10):
+    for dan in range(9):
+        square = str(suji) + chr(DAN1 + dan)
+        SQUARE_INDEX[square] = (9 - suji) + 9 * dan
+        SQUARE_NAMES[square] = SUJI_NAMES[suji] + DAN_NAMES[dan]
+        SQUARE_NUMBERS[square] = str(suji) + str(dan + 1)
+del suji, dan, square
+# 打つ駒(USI形式の大文字)の数
+DROP_CODES = {Position.SFEN_KOMA[i]: i for i in range(1, 8)}
+
 
 class Sfen2kif:
+    """USI形式の指し手を、表引きと盤面の配列だけで棋譜(KIF)に変換する"""
+
     @staticmethod
     def str2pos(suji, dan):
-        dan_num = ord(dan) - DAN1
-        return SUJI_NAMES[int(suji)] + DAN_NAMES[dan_num]
+        return SQUARE_NAMES[suji + dan]
 
     @staticmethod
-    def parse_moves(sfen, sfen_moves):
-        board = shogi.Board(sfen)
-        moves = sfen_moves.split()
-        teban = 0 if " b " in sfen else 1
+    def __moves(position, sfen_moves):
+        """指し手ごとに(手番, 移動先, 前の指し手と同じ移動先か, 動かす駒の数, 成るか, 移動元)を返す
+
+        移動元は打つ場合はNone。盤面は駒の種類だけを持ち、先手・後手は区別しない"""
+        board = [abs(code) for code in position.board]
+        teban = position.teban
         pre_pos = None
-        kif = ""
-        for move in moves:
-            from1 = move[0:1]
-            from2 = move[1:2]
+        for move in sfen_moves.split():
             to_pos = move[2:4]
-            to1 = move[2:3]
-            to2 = move[3:4]
-            to3 = move[4:5]
-            if pre_pos == to_pos:
-                pos_str = "同"
-            else:
-                pos_str = Sfen2kif.str2pos(to1, to2)
-            if from2 == "*":
-                koma = shogi.Piece.from_symbol(from1)
-            else:
-                dan_num = ord(from2) - DAN1
-                koma = board.piece_at((9 - int(from1)) + 9 * (dan_num))
-            koma_str = koma.japanese_symbol()
-            if to3 == "+":
-                koma_str = koma_str + "成"
-            if from2 == "*":
-                kif = kif + TEBAN[teban] + pos_str + koma_str + "打 "
-            else:
-                kif = (
-                    kif
-                    + TEBAN[teban]
-                    + pos_str
-                    + koma_str
-                    + "("
-                    + Sfen2kif.str2pos(from1, from2)
-                    + ") "
+            promote = move[4:5] == "+"
+            try:
+                if move[1:2] == "*":
+                    from_pos = None
+                    koma = DROP_CODES[move[0:1]]
+                else:
+                    from_pos = move[0:2]
+                    from_index = SQUARE_INDEX[from_pos]
+                    koma = board[from_index]
+                    board[from_index] = 0
+                board[SQUARE_INDEX[to_pos]] = (
+                    koma + Position.PROMOTED if promote else koma
                 )
+            except KeyError:
+                raise ValueError("invalid move: " + move)
+            if koma == 0:
+                raise ValueError("no piece at: " + move)
+            yield (teban, to_pos, pre_pos == to_pos, koma, promote, from_pos)
             pre_pos = to_pos
-            board.push(shogi.Move.from_usi(move))
-            teban = 1 if teban == 0 else 0
-        return kif
+            teban = 1 - teban
+
+    @staticmethod
+    def parse_moves(sfen, sfen_moves):
+        """sfen形式の局面からのUSI形式の指し手を、"▲５二歩打 △同玉(６一) "のような棋譜にする"""
+        kif = []
+        for (teban, to_pos, same, koma, promote, from_pos) in Sfen2kif.__moves(
+            Position.from_sfen(sfen), sfen_moves
+        ):
+            kif.append(TEBAN[teban])
+            kif.append("同" if same else SQUARE_NAMES[to_pos])
+            kif.append(KOMA_NAMES[koma])
+            if promote:
+                kif.append("成")
+            if from_pos is None:
+                kif.append("打 ")
+            else:
+                kif.append("(" + SQUARE_NAMES[from_pos] + ") ")
+        return "".join(kif)
+
+    @staticmethod
+    def kif_file(sfen, sfen_moves, result="詰み"):
+        """KIF形式の棋譜ファイルの内容(局面図と指し手)にする、resultは最後の「まで○手で」に続く文字列"""
+        position = Position.from_sfen(sfen)
+        lines = ["後手の持駒：" + Sfen2kif.__hand(position.hands[1])]
+        lines.append("  ９ ８ ７ ６ ５ ４ ３ ２ １")
+        lines.append("+---------------------------+")
+        for dan in range(9):
+            row = "|"
+            for code in position.board[dan * 9 : dan * 9 + 9]:
+                row += ("v" if code < 0 else " ") + BOD_KOMA_NAMES[abs(code)]
+            lines.append(row + "|" + DAN_NAMES[dan])
+        lines.append("+---------------------------+")
+        lines.append("先手の持駒：" + Sfen2kif.__hand(position.hands[0]))
+        if position.teban == 1:
+            lines.append("後手番")
+        lines.append("手数----指手---------消費時間--")
+        number = 0
+        for (number, (_, to_pos, same, koma, promote, from_pos)) in enumerate(
+            Sfen2kif.__moves(position, sfen_moves), 1
+        ):
+            move = ("同　" if same else SQUARE_NAMES[to_pos]) + KIF_KOMA_NAMES[koma]
+            if promote:
+                move += "成"
+            if from_pos is None:
+                move += "打"
+            else:
+                move += "(" + SQUARE_NUMBERS[from_pos] + ")"
+            lines.append("%4d %s" % (number, move))
+        if number > 0 and result:
+            lines.append("まで" + str(number) + "手で" + result)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __hand(hand):
+        """持ち駒を"飛　金二　歩三"のように飛車から順に並べる"""
+        names = [
+            KOMA_NAMES[i] + KANJI_NUMBERS[hand[i]]
+            for i in range(7, 0, -1)
+            if hand[i] > 0
+        ]
+        return "　".join(names) if names else "なし"
+
+    @staticmethod
+    def parse_many(items, kif_file=False):
+        """(sfen, 指し手)の組をまとめて棋譜にする、kif_fileならKIF形式の棋譜ファイルの内容にする"""
+        convert = Sfen2kif.kif_file if kif_file else Sfen2kif.parse_moves
+        return [convert(sfen, sfen_moves) for (sfen, sfen_moves) in items]
 
 
 if __name__ == "__main__":
     sfen = "l3k3l/6G2/2+NSsppGp/pp2p4/5+r3/5s3/1P6P/2P1S1GP1/L1G1K2NL b NPr2bn7p 1"
     kif = Sfen2kif.parse_moves(sfen, "P*5b 5a6a 7c7b")
     print(kif)
+    print(Sfen2kif.kif_file(sfen, "P*5b 5a6a 7c7b"))
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import argparse
+import os
+import numpy as np
+import cv2
+from PIL import Image
+
+# python -m shogiimagesolver.stream でも実行できるように、パッケージ内かどうかで判定する
+if __package__:
+    from .boardimage import BoardImage
+    from .geometrycache import GeometryCache
+    from .imagecache import ImageCache
+    from .imagesolver import ImageSolver
+    from .batch import find_files
+else:
+    from boardimage import BoardImage
+    from geometrycache import GeometryCache
+    from imagecache import ImageCache
+    from imagesolver import ImageSolver
+    from batch import find_files
+
+"""画面録画や連続したキャプチャ画像から、盤面が変わったときだけ詰み探索するツール"""
+
+
+class FrameStream:
+    """連続したフレームを受け取り、盤の部分が変わったときだけ解析・詰み探索する
+
+    変わったかどうかは、前回の盤の位置で切り抜いて縮小した画像の差で判定するので、
+    変わっていないフレームは盤の検出も駒の判定もしない。
+    変わったフレームも、前回解析した盤と比べて変わったマス・持ち駒だけ判定し直す"""
+
+    def __init__(self, solver, max_diff=10, stable_frames=0):
+        self.solver = solver
+        # 同じとみなす、縮小画像の画素値の差の最大値(JPEGのノイズは7程度、成駒への変化は20程度)
+        self.max_diff = max_diff
+        # 変わった後、この枚数だけ同じフレームが続いてから解析する(アニメーション中を除く)
+        self.stable_frames = stable_frames
+        self.geometry_cache = solver.geometry_cache or GeometryCache()
+        self.frames = 0
+        self.solved = 0
+        self.__box = None
+        self.__fingerprint = None
+        self.__stable_count = 0
+        self.__pending = False
+        # 前回解析した盤の画像と、マスごとの駒・持ち駒ごとの(駒, 枚数)
+        self.__previous = (None, None, None)
+
+    @staticmethod
+    def frame_size(frame):
+        """フレーム(OpenCV形式のBGR画像かPillow形式の画像)の(幅, 高さ)"""
+        if isinstance(frame, np.ndarray):
+            return (frame.shape[1], frame.shape[0])
+        return frame.size
+
+    @staticmethod
+    def to_pil(frame):
+        if isinstance(frame, np.ndarray):
+            if frame.ndim == 2:
+                return Image.fromarray(frame)
+            return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        return frame
+
+    @staticmethod
+    def fingerprint(frame, box):
+        """盤の部分を切り抜いてグレースケールで縮小した画像、盤の部分が画像からはみ出すならNone"""
+        (left, top, right, bottom) = box
+        (width, height) = FrameStream.frame_size(frame)
+        if left < 0 or top < 0 or right > width or bottom > height:
+            return None
+        if isinstance(frame, np.ndarray):
+            # 縮小画像の1画素あたり4x4画素程度になるよう間引いてから縮小する
+            step = max(
+                1,
+                min(bottom - top, right - left) // (ImageCache.FINGERPRINT_SIZE[0] * 4),
+            )
+            region = frame[top:bottom:step, left:right:step]
+            small = cv2.resize(
+                region, ImageCache.FINGERPRINT_SIZE, interpolation=cv2.INTER_AREA
+            )
+            if small.ndim == 3:
+                small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        else:
+            small = np.asarray(
+                frame.crop(box)
+                .convert("L")
+                .resize(ImageCache.FINGERPRINT_SIZE, Image.BOX)
+            )
+        return small.astype(np.int16)
+
+    def __is_same(self, fingerprint):
+        return (
+            fingerprint is not None
+            and self.__fingerprint is not None
+            and fingerprint.shape == self.__fingerprint.shape
+            and int(np.abs(fingerprint - self.__fingerprint).max()) <= self.max_diff
+        )
+
+    def process(self, frame):
+        """フレームを1枚処理して、詰み探索した場合は(結果, sfen, csa, 盤部分の画像)、しなければNoneを返す"""
+        self.frames += 1
+        if self.__box is not None:
+            fingerprint = FrameStream.fingerprint(frame, self.__box)
+            if self.__is_same(fingerprint):
+                if not self.__pending:
+                    return None
+                self.__stable_count += 1
+                if self.__stable_count < self.stable_frames:
+                    return None
+            else:
+                # 変わった直後は、同じフレームが続くのを待つ
+                self.__fingerprint = fingerprint
+                self.__stable_count = 0
+                self.__pending = True
+                if self.stable_frames > 0 and fingerprint is not None:
+                    return None
+        return self.__solve(frame)
+
+    def __solve(self, frame):
+        self.__pending = False
+        board_image = BoardImage(FrameStream.to_pil(frame), self.geometry_cache)
+        if not board_image.is_board:
+            # 盤のないフレームも、画面全体が変わるまでは調べ直さない
+            self.__box = (0, 0) + FrameStream.frame_size(frame)
+            self.__fingerprint = FrameStream.fingerprint(frame, self.__box)
+            return None
+        self.__box = board_image.trimmed_box()
+        self.__fingerprint = FrameStream.fingerprint(frame, self.__box)
+        self.solved += 1
+        (sfen, csa, komas, mochigomas) = self.solver.image_to_sfen_incremental(
+            board_image, *self.__previous
+        )
+        if sfen is None:
+            self.__previous = (None, None, None)
+            return ("parse_NG", None, None, board_image.trimmed_image())
+        self.__previous = (board_image, komas, mochigomas)
+        (result, sfen, csa) = self.solver.solve_from_sfen(sfen, csa)
+        return (result, sfen, csa, board_image.trimmed_image())
+
+    def run(self, frames):
+        """フレームを順に処理して、詰み探索したフレームの(番号, 結果)を返す"""
+        for (index, frame) in enumerate(frames):
+            result = self.process(frame)
+            if result is not None:
+                yield (index, result)
+
+
+def read_video(file_name, step=1):
+    """動画ファイルをOpenCVで読み込んで、stepフレームごとにBGR画像を返す"""
+    capture = cv2.VideoCapture(file_name)
+    if not capture.isOpened():
+        raise OSError("cannot open video: " + file_name)
+    try:
+        index = 0
+        while True:
+            if index % step == 0:
+                (ok, frame) = capture.read()
+            else:
+                ok = capture.grab()
+                frame = None
+            if not ok:
+                break
+            if frame is not None:
+                yield frame
+            index += 1
+    finally:
+        capture.release()
+
+
+def read_images(files):
+    """画像ファイルを順に読み込んで返す"""
+    for file_name in files:
+        yield Image.open(file_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="画面録画や連続したキャプチャ画像から、盤面が変わったときだけ詰み探索する")
+    parser.add_argument("input", nargs="+", help="動画ファイル/画像ファイル/ディレクトリ/globパターン")
+    parser.add_argument("--step", type=int, default=1, help="動画の何フレームごとに調べるか")
+    parser.add_argument("--max-diff", type=int, default=10, help="同じとみなす画素値の差")
+    parser.add_argument(
+        "--stable-frames", type=int, default=2, help="変わった後、何フレーム同じなら解析するか"
+    )
+    parser.add_argument("--engine", help="詰将棋エンジンのパス")
+    parser.add_argument("--hash", type=int, default=128, help="エンジンのUSI_HASH")
+    args = parser.parse_args(argv)
+    is_video = len(args.input) == 1 and os.path.isfile(args.input[0])
+    if is_video and not args.input[0].lower().endswith((".jpg", ".jpeg", ".png")):
+        frames = read_video(args.input[0], args.step)
+    else:
+        frames = read_images(find_files(args.input))
+    solver = ImageSolver(
+        engine=args.engine, options=[("USI_HASH", args.hash)], image_cache=False
+    )
+    try:
+        stream = FrameStream(solver, args.max_diff, args.stable_frames)
+        for (index, (result, sfen, csa, _)) in stream.run(frames):
+            print("frame=" + str(index) + ", result=" + result + "\nsfen=" + str(sfen))
+        print("frames=" + str(stream.frames) + ", solved=" + str(stream.solved))
+    finally:
+        solver.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import argparse
+import json
+import os
+import random
+import numpy as np
+import cv2
+
+# python -m shogiimagesolver.synthetic でも実行できるように、パッケージ内かどうかで判定する
+if __package__:
+    from .komadetector import KomaDetector
+    from .mochigomadetector import MochigomaDetector
+else:
+    from komadetector import KomaDetector
+    from mochigomadetector import MochigomaDetector
+
+"""sfen形式の局面から、将棋クエスト風のスクリーンショット画像を作るツール
+
+駒の画像はbankoma/mochigoma_senteのサンプル画像を使う。
+作った画像の正解(sfen)がわかっているので、画像解析の性能測定に使える"""
+
+SFEN_KOMA = "PLNSGBRK"
+KOMA_QTY = [0, 18, 4, 4, 4, 4, 2, 2, 2]
+NARI_KOMA = [1, 2, 3, 4, 6, 7]
+
+
+class SyntheticBoard:
+    """盤・持ち駒の位置を決めて、sfen形式の局面を画像にする"""
+
+    BACKGROUND = 70
+    BOARD = 190
+    LINE = 20
+
+    def __init__(
+        self,
+        width=1080,
+        height=2400,
+        koma_dir=KomaDetector.TEACHER_IMG_DIR,
+        mochigoma_dir=MochigomaDetector.TEACHER_IMG_DIR,
+    ):
+        self.width = width
+        self.height = height
+        self.koma_dir = koma_dir
+        self.mochigoma_dir = mochigoma_dir
+        self.__calc_layout()
+        self.__glyphs = {}
+        self.__base = self.__render_base()
+
+    def __calc_layout(self):
+        """盤・持ち駒の位置を決める(BoardImageが検出する位置と一致させる)"""
+        self.line = max(1, self.width // 540)
+        ban_width = int(self.width * 0.9)
+        ban_height = int(ban_width * 1.09)
+        self.ban_left = (self.width - ban_width) // 2
+        self.ban_right = self.ban_left + ban_width + self.line - 1
+        self.ban_top = (self.height - ban_height) // 2
+        self.ban_bottom = self.ban_top + ban_height + self.line - 1
+        self.cell_width = ban_width / 9
+        self.cell_height = ban_height / 9
+        self.margin = max(2, int(self.cell_width * 0.25))
+        # 盤の外側の最初の行/列
+        self.board_top = self.ban_top - self.margin - 1
+        self.board_bottom = self.ban_bottom + self.margin + 1
+        # 持ち駒の位置
+        block_height = int((self.ban_bottom - self.ban_top) / 9)
+        block_width = int((self.ban_right - self.ban_left) / 9)
+        edge_y = int((self.ban_top - self.board_top) * 1.2)
+        self.mochigoma_width = int(block_width * 0.99)
+        self.mochigoma_height = block_height
+        self.gote_mochigoma_top = self.board_top - edge_y - block_height
+        self.sente_mochigoma_top = self.board_bottom + edge_y
+        if self.gote_mochigoma_top < 0 or (
+            self.sente_mochigoma_top + block_height > self.height
+        ):
+            raise ValueError("image is too small for the board")
+
+    def __glyph(self, fname, size):
+        """サンプル画像をグレースケールで読み込んで指定サイズにする"""
+        key = (fname, size)
+        if key not in self.__glyphs:
+            img = cv2.imread(fname, cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                raise FileNotFoundError(fname)
+            self.__glyphs[key] = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        return self.__glyphs[key]
+
+    def __cell(self, i, j):
+        """i段目j列目(左上から)のマスの内側の範囲"""
+        y0 = self.ban_top + int(self.cell_height * i) + self.line
+        x0 = self.ban_left + int(self.cell_width * j) + self.line
+        y1 = self.ban_top + int(self.cell_height * (i + 1))
+        x1 = self.ban_left + int(self.cell_width * (j + 1))
+        return (x0, y0, x1, y1)
+
+    def __render_base(self):
+        """駒のない盤の画像"""
+        img = np.full((self.height, self.width), self.BACKGROUND, dtype=np.uint8)
+        img[
+            self.board_top + 1 : self.board_bottom,
+            self.ban_left - self.margin : self.ban_right + self.margin + 1,
+        ] = self.BOARD
+        for k in range(10):
+            y = self.ban_top + int(self.cell_height * k)
+            x = self.ban_left + int(self.cell_width * k)
+            img[y : y + self.line, self.ban_left : self.ban_right + 1] = self.LINE
+            img[self.ban_top : self.ban_bottom + 1, x : x + self.line] = self.LINE
+        empty = self.koma_dir + "/00.png"
+        for i in range(9):
+            for j in range(9):
+                self.__paste(img, self.__cell(i, j), empty)
+        return img
+
+    def __paste(self, img, box, fname):
+        (x0, y0, x1, y1) = box
+        img[y0:y1, x0:x1] = self.__glyph(fname, (x1 - x0, y1 - y0))
+
+    def __koma_file(self, koma, is_sente):
+        """駒の番号(成駒は+10)に対応するサンプル画像"""
+        return self.koma_dir + "/%02d%s.png" % (koma, "" if is_sente else "r")
+
+    def __paste_mochigoma(self, img, top, idx, qty):
+        x = self.ban_left + self.mochigoma_width * idx
+        box = (x, top, x + self.mochigoma_width, top + self.mochigoma_height)
+        name = MochigomaDetector.KOMA_NAMES[idx]
+        self.__paste(img, box, "%s/%s%d.png" % (self.mochigoma_dir, name, min(qty, 2)))
+        if qty <= 2:
+            return
+        # 3枚以上は右下に枚数の数字を重ねる
+        num = cv2.imread(
+            "%s/num%d.png" % (self.mochigoma_dir, qty), cv2.IMREAD_GRAYSCALE
+        )
+        if num is None:
+            return
+        scale_x = self.mochigoma_width / MochigomaDetector.IMG_SIZE[0]
+        scale_y = self.mochigoma_height / MochigomaDetector.IMG_SIZE[1]
+        size = (
+            max(1, int(num.shape[1] * scale_x)),
+            max(1, int(num.shape[0] * scale_y)),
+        )
+        (x1, y1) = (box[2] - 2, box[3] - 2)
+        self.__paste(
+            img,
+            (x1 - size[0], y1 - size[1], x1, y1),
+            "%s/num%d.png" % (self.mochigoma_dir, qty),
+        )
+
+    def render(self, sfen):
+        """sfen形式の局面をOpenCV形式(BGR)の画像にする"""
+        (board, _, hands) = sfen.split()[:3]
+        img = self.__base.copy()
+        for (i, row) in enumerate(board.split("/")):
+            j = 0
+            promoted = False
+            for c in row:
+                if c.isdigit():
+                    j += int(c)
+                elif c == "+":
+                    promoted = True
+                else:
+                    koma = SFEN_KOMA.index(c.upper()) + 1 + (10 if promoted else 0)
+                    self.__paste(
+                        img, self.__cell(i, j), self.__koma_file(koma, c.isupper())
+                    )
+                    promoted = False
+                    j += 1
+        sente_hands = [0] * 7
+        qty = 0
+        for c in hands:
+            if c.isdigit():
+                qty = qty * 10 + int(c)
+            elif c != "-":
+                if c.isupper():
+                    sente_hands[SFEN_KOMA.index(c)] = max(qty, 1)
+                qty = 0
+        for idx in range(7):
+            self.__paste_mochigoma(img, self.gote_mochigoma_top, idx, 0)
+            self.__paste_mochigoma(img, self.sente_mochigoma_top, idx, sente_hands[idx])
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+    def render_jpeg(self, sfen, quality=90):
+        """sfen形式の局面をJPEG形式の画像データにする"""
+        (_, buf) = cv2.imencode(
+            ".jpg", self.render(sfen), [cv2.IMWRITE_JPEG_QUALITY, quality]
+        )
+        return buf.tobytes()
+
+
+def random_sfen(rng=random):
+    """ランダムな詰将棋風の局面(後手玉あり、残りの駒は後手の持ち駒)"""
+    squares = rng.sample(range(81), rng.randint(4, 20))
+    board = [""] * 81
+    rest = list(KOMA_QTY)
+    board[squares[0]] = "k"
+    rest[8] -= 1
+    for square in squares[1:]:
+        koma = rng.choice([k for k in range(1, 8) if rest[k] > 0])
+        rest[koma] -= 1
+        name = SFEN_KOMA[koma - 1]
+        if koma in NARI_KOMA and rng.random() < 0.2:
+            name = "+" + name
+        board[square] = name if rng.random() < 0.5 else name.lower()
+    sente_hands = [0] * 9
+    for koma in range(1, 8):
+        if rest[koma] > 0 and rng.random() < 0.3:
+            sente_hands[koma] = rng.randint(1, min(rest[koma], 3))
+            rest[koma] -= sente_hands[koma]
+    rows = []
+    for i in range(9):
+        row = ""
+        blank = 0
+        for j in range(9):
+            name = board[i * 9 + j]
+            if name == "":
+                blank += 1
+                continue
+            if blank:
+                row += str(blank)
+                blank = 0
+            row += name
+        if blank:
+            row += str(blank)
+        rows.append(row)
+    hands = ""
+    for (qty_list, is_sente) in [(sente_hands, True), (rest, False)]:
+        for koma in range(1, 8):
+            if qty_list[koma] > 1:
+                hands += str(qty_list[koma])
+            if qty_list[koma] >= 1:
+                name = SFEN_KOMA[koma - 1]
+                hands += name if is_sente else name.lower()
+    return "/".join(rows) + " b " + (hands or "-") + " 1"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="sfen形式の局面から将棋アプリ風のスクリーンショット画像を作る")
+    parser.add_argument("--sfen", action="append", help="局面(省略時はランダム)")
+    parser.add_argument("--count", type=int, default=100, help="ランダムな局面の数")
+    parser.add_argument("--out", default="./testin", help="出力ディレクトリ")
+    parser.add_argument("--width", type=int, default=1080)
+    parser.add_argument("--height", type=int, default=2400)
+    parser.add_argument("--quality", type=int, default=90, help="JPEGの品質")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    rng = random.Random(args.seed)
+    sfens = args.sfen or [random_sfen(rng) for _ in range(args.count)]
+    synthetic_board = SyntheticBoard(args.width, args.height)
+    os.makedirs(args.out, exist_ok=True)
+    # 正解の局面をJSON Lines形式で出力する
+    with open(os.path.join(args.out, "ground_truth.jsonl"), "w", encoding="utf-8") as f:
+        for (i, sfen) in enumerate(sfens):
+            file_name = os.path.join(args.out, "synthetic_%05d.jpg" % i)
+            with open(file_name, "wb") as img_file:
+                img_file.write(synthetic_board.render_jpeg(sfen, args.quality))
+            f.write(json.dumps({"image": file_name, "sfen": sfen}) + "\n")
+    print(str(len(sfens)) + " images -> " + args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import glob
+import hashlib
+import os
+import tempfile
+import zipfile
+
+if __name__ == "__main__" or __package__ == "":
+    from lazyimport import lazy_import
+else:
+    from .lazyimport import lazy_import
+
+# numpy・OpenCVは最初に使うときに読み込む
+np = lazy_import("numpy", globals(), "np")
+cv2 = lazy_import("cv2", globals())
+
+
+class TeacherCache:
+    """サンプル画像から準備した比較用データを、ファイルに保存して再利用する
+
+    キャッシュはサンプル画像の内容とパラメータから求めたキーで管理し、
+    サンプル画像が変わればキーが一致しなくなるので作り直す"""
+
+    VERSION = 1
+
+    def __init__(self, sample_dir, name, params, cache_dir=None):
+        self.sample_dir = sample_dir
+        if cache_dir is None:
+            cache_dir = os.environ.get("SHOGI_CACHE_DIR", sample_dir)
+        self.file_name = os.path.join(cache_dir, "." + name + "_cache.npz")
+        self.key = self.__calc_key(name, params)
+
+    def __calc_key(self, name, params):
+        """サンプル画像の内容とパラメータのハッシュ値を求める"""
+        digest = hashlib.sha256()
+        digest.update(
+            repr((self.VERSION, name, cv2.__version__, params)).encode("utf-8")
+        )
+        for fname in sorted(glob.glob(os.path.join(self.sample_dir, "*.png"))):
+            digest.update(os.path.basename(fname).encode("utf-8"))
+            with open(fname, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        return digest.hexdigest()
+
+    def load(self, unpack=None):
+        """キーが一致すればキャッシュの内容を辞書で返す、unpackを指定すれば辞書を渡した戻り値を返す
+
+        ファイルが壊れている・必要な配列がないなど、読めないキャッシュはないものとして作り直させる"""
+        try:
+            with np.load(self.file_name) as data:
+                if "key" not in data or str(data["key"]) != self.key:
+                    return None
+                arrays = {name: data[name] for name in data.files}
+            return arrays if unpack is None else unpack(arrays)
+        except (
+            OSError,
+            EOFError,
+            ValueError,
+            KeyError,
+            IndexError,
+            zipfile.BadZipFile,
+        ):
+            return None
+
+    def save(self, arrays):
+        """キャッシュを保存する、保存できなくても処理は続ける"""
+        tmp_name = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(self.file_name) or ".",
+                suffix=".npz",
+                delete=False,
+            ) as f:
+                tmp_name = f.name
+                np.savez(f, key=np.array(self.key), **arrays)
+            # 他のプロセスが読み込み中でも壊れないように置き換える
+            os.replace(tmp_name, self.file_name)
+        except OSError:
+            if tmp_name and os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+    @staticmethod
+    def orb_params(detector):
+        """キャッシュのキーに含めるORBのパラメータ"""
+        return (
+            detector.getMaxFeatures(),
+            detector.getScaleFactor(),
+            detector.getNLevels(),
+            detector.getEdgeThreshold(),
+            detector.getFirstLevel(),
+            detector.getWTA_K(),
+            int(detector.getScoreType()),
+            detector.getPatchSize(),
+            detector.getFastThreshold(),
+        )
+
+    @staticmethod
+    def pack_descriptors(des_list):
+        """特徴量のリストを、連結した行列と各要素の行数(Noneは-1)にまとめる"""
+        counts = np.array(
+            [-1 if des is None else len(des) for des in des_list], dtype=np.int32
+        )
+        packed = [des for des in des_list if des is not None]
+        if packed:
+            return (np.vstack(packed), counts)
+        return (np.zeros((0, 32), dtype=np.uint8), counts)
+
+    @staticmethod
+    def unpack_descriptors(des, counts):
+        """pack_descriptorsでまとめたものを特徴量のリストに戻す"""
+        des_list = []
+        offset = 0
+        for count in counts:
+            if count < 0:
+                des_list.append(None)
+                continue
+            des_list.append(des[offset : offset + count])
+            offset += count
+        return des_list
@@ -1,84 +1,242 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
-import asyncio
+import math
 import sys
-from asyncio.subprocess import PIPE
+import threading
 import locale
 import os.path
 
+if __name__ == "__main__" or __package__ == "":
+    from instrument import tracer
+    from lazyimport import lazy_import
+else:
+    from .instrument import tracer
+    from .lazyimport import lazy_import
+
+# asyncioは最初に使うときに読み込む
+asyncio = lazy_import("asyncio", globals())
+
+
+class LoopThread:
+    """イベントループを専用のスレッドで動かし続ける"""
+
+    def __init__(self, name="usi-loop"):
+        if sys.platform == "win32":
+            self.loop = asyncio.ProactorEventLoop()
+        else:
+            self.loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__run, name=name, daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """コルーチンをループで実行して、concurrent.futures.Futureを返す"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        """ループを止めてスレッドの終了を待つ"""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if threading.current_thread() is not self.__thread:
+            self.__thread.join()
+            self.loop.close()
+
 
 class UsiEngine:
-    """timeout秒以上無応答が続くと、打ち切って結果を返すUSIプロトコル将棋エンジンクライアント"""
+    """timeout秒以内に応答がなければ、打ち切って結果を返すUSIプロトコル将棋エンジンクライアント
 
-    def __init__(self, engine_cmd, timeout=3, debug=False, listener=None):
+    エンジンとの入出力は専用スレッドのイベントループで行い、標準出力は常に読み続けて
+    subscribe()で登録した関数に1行ずつ渡す。各コマンドは*_futureでFutureとして実行でき、
+    同名のメソッドはその結果を待つ"""
+
+    # 応答待ちで返す行に含めない(subscribe()で登録した関数にだけ渡す)行
+    PROGRESS_RESPONSES = ["info"]
+
+    def __init__(
+        self,
+        engine_cmd,
+        timeout=3,
+        debug=False,
+        listener=None,
+        new_loop=False,
+        loop=None,
+    ):
         self.engine_cmd = engine_cmd
         self.debug = debug
         self.listener = listener
         if debug and not listener:
             self.listener = print
         self.timeout = timeout
-        if sys.platform == "win32":
-            self.loop = asyncio.ProactorEventLoop()
-            asyncio.set_event_loop(self.loop)
-        else:
-            self.loop = asyncio.get_event_loop()
-        self.loop.run_until_complete(self.run_engine())
+        # 最後の応答待ちでEOF/タイムアウト(stopしても応答がなかった)になったか
+        self.eof = False
+        self.timed_out = False
+        self.proc = None
+        self.__subscribers = []
+        if self.listener:
+            self.__subscribers.append(self.listener)
+        # 応答待ち中のコマンドに行を渡すキュー
+        self.__collector = None
+        self.__reader = None
+        self.__command_lock = None
+        self.__loop_thread = None
+        if loop is not None:
+            # 実行中のループを使う場合、起動(run_engine)は呼び出し側で待つ
+            self.loop = loop
+            return
+        # new_loopは互換のため残している(エンジンごとに専用スレッドのループを持つ)
+        self.__loop_thread = LoopThread()
+        self.loop = self.__loop_thread.loop
+        try:
+            self.submit(self.run_engine()).result()
+        except BaseException:
+            # 起動できなければループのスレッドも止める
+            self.__loop_thread.stop()
+            self.loop = None
+            raise
+
+    @staticmethod
+    async def create(engine_cmd, timeout=3, debug=False, listener=None):
+        """実行中のイベントループ上でエンジンを起動する(asyncio用)"""
+        usi = UsiEngine(
+            engine_cmd,
+            timeout=timeout,
+            debug=debug,
+            listener=listener,
+            loop=asyncio.get_running_loop(),
+        )
+        await usi.run_engine()
+        return usi
 
     async def run_engine(self):
+        # 読み筋の長いinfo行でも読めるよう、1行の上限を広げる
+        PIPE = asyncio.subprocess.PIPE
         self.proc = await asyncio.create_subprocess_exec(
-            self.engine_cmd, stdout=PIPE, stderr=PIPE, stdin=PIPE
+            self.engine_cmd, stdout=PIPE, stderr=PIPE, stdin=PIPE, limit=2**20
         )
+        self.__command_lock = asyncio.Lock()
+        self.__reader = asyncio.ensure_future(self.__read_stdout())
+
+    def submit(self, coro):
+        """コルーチンをエンジンのイベントループで実行して、concurrent.futures.Futureを返す"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def subscribe(self, callback):
+        """エンジンが出力した行を1行ずつ受け取る関数を登録する(イベントループのスレッドから呼ばれる)"""
+        self.__subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.__subscribers:
+            self.__subscribers.remove(callback)
+
+    async def __read_stdout(self):
+        """標準出力を読み続けて、登録された関数と応答待ち中のコマンドに渡す"""
+        while True:
+            line = await self.proc.stdout.readline()
+            if not line:  # EOF
+                self.eof = True
+                if self.__collector is not None:
+                    self.__collector.put_nowait(None)
+                break
+            line = line.strip().decode(locale.getpreferredencoding())
+            for subscriber in list(self.__subscribers):
+                subscriber(line)
+            if self.__collector is not None:
+                self.__collector.put_nowait(line)
 
     async def usi_cmd(self, cmd):
         if self.listener:
             self.listener(cmd)
         self.proc.stdin.write(cmd.encode(locale.getpreferredencoding()) + b"\n")
 
-    async def wait_until(self, end_responses, timeout=None):
-        if not timeout:
+    async def wait_until(self, end_responses, timeout=None, stoppable=False):
+        """end_responsesで始まる行が来るまでの行を返す
+
+        timeoutは応答全体の待ち時間(秒、math.infなら無制限)。stoppableなら(go/go mate)、
+        時間切れ・キャンセル時にstopを送って、打ち切った結果をtimeout秒だけ待つ"""
+        if timeout is None:
             timeout = self.timeout
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout == math.inf else loop.time() + timeout
         lines = []
-        while True:
-            try:
-                line = await asyncio.wait_for(self.proc.stdout.readline(), timeout)
-            except asyncio.TimeoutError:
-                if self.listener:
-                    self.listener("timeout")
-            else:
-                if not line:  # EOF
+        self.timed_out = False
+        collector = asyncio.Queue()
+        self.__collector = collector
+        if self.eof:
+            collector.put_nowait(None)
+        try:
+            while True:
+                remaining = None if deadline is None else max(deadline - loop.time(), 0)
+                try:
+                    line = await asyncio.wait_for(collector.get(), remaining)
+                except asyncio.TimeoutError:
+                    if self.listener:
+                        self.listener("timeout")
+                    if stoppable and self.is_alive():
+                        # 思考を止めて、打ち切った結果(checkmate timeoutなど)を待つ
+                        stoppable = False
+                        await self.usi_cmd("stop")
+                        deadline = loop.time() + self.timeout
+                        continue
+                    self.timed_out = True
+                    break
+                if line is None:  # EOF
                     break
-                line = line.strip().decode(locale.getpreferredencoding())
-                lines.append(line)
-                if self.listener:
-                    self.listener(line)
-                for end_res in end_responses:
-                    if line.startswith(end_res):
-                        break
-                else:
-                    continue
-            break
+                if not any(line.startswith(res) for res in self.PROGRESS_RESPONSES):
+                    lines.append(line)
+                if any(line.startswith(res) for res in end_responses):
+                    break
+        except asyncio.CancelledError:
+            if stoppable and self.is_alive():
+                # 打ち切った結果を読み捨ててから戻り、次のコマンドの応答と混ざらないようにする
+                await self.usi_cmd("stop")
+                try:
+                    await asyncio.wait_for(
+                        self.__discard_until(collector, end_responses), self.timeout
+                    )
+                except asyncio.TimeoutError:
+                    self.timed_out = True
+            raise
+        finally:
+            self.__collector = None
         return lines
 
-    def usi(self):
-        self.loop.run_until_complete(self.usi_cmd("usi"))
-        return self.loop.run_until_complete(self.wait_until(["usiok"]))
+    @staticmethod
+    async def __discard_until(collector, end_responses):
+        while True:
+            line = await collector.get()
+            if line is None or any(line.startswith(res) for res in end_responses):
+                return
 
-    def isready(self):
-        self.loop.run_until_complete(self.usi_cmd("isready"))
-        return self.loop.run_until_complete(self.wait_until(["readyok"]))
+    async def usi_async(self):
+        async with self.__command_lock:
+            await self.usi_cmd("usi")
+            return await self.wait_until(["usiok"])
 
-    def setoption(self, name, value):
-        cmd = "setoption name " + name + " value " + str(value)
-        self.loop.run_until_complete(self.usi_cmd(cmd))
+    async def isready_async(self):
+        async with self.__command_lock:
+            with tracer.stage("isready"):
+                await self.usi_cmd("isready")
+                return await self.wait_until(["readyok"])
 
-    def position(self, moves=None, sfen="startpos"):
+    async def setoption_async(self, name, value):
+        async with self.__command_lock:
+            await self.usi_cmd("setoption name " + name + " value " + str(value))
+
+    async def position_async(self, moves=None, sfen="startpos"):
         cmd = "position " + sfen
         if moves:
             cmd += " moves " + " ".join(moves)
-        self.loop.run_until_complete(self.usi_cmd(cmd))
+        async with self.__command_lock:
+            await self.usi_cmd(cmd)
 
-    def go(self, ponder=False, infinite=False, btime=None, wtime=None):
+    async def go_async(
+        self, ponder=False, infinite=False, btime=None, wtime=None, deadline=None
+    ):
+        """deadline秒(省略時はtimeout秒)待ってもbestmoveが来なければ、
+        infiniteならそのまま(stopは呼び出し側で送る)、そうでなければstopして結果を返す"""
         cmd = "go"
         if ponder:
             cmd += " ponder"
@@ -89,39 +247,104 @@ class UsiEngine:
                 cmd += " btime " + str(btime)
             if wtime is not None:
                 cmd += " wtime " + str(wtime)
-        self.loop.run_until_complete(self.usi_cmd(cmd))
-        return self.loop.run_until_complete(self.wait_until(["bestmove", "checkmate"]))
+        async with self.__command_lock:
+            await self.usi_cmd(cmd)
+            return await self.wait_until(
+                ["bestmove", "checkmate"], timeout=deadline, stoppable=not infinite
+            )
 
-    def go_mate(self, byoyomi=None):
+    async def go_mate_async(self, byoyomi=None, deadline=None):
+        """deadline秒(省略時はbyoyomiにtimeout秒を加えた時間、byoyomiもなければ無制限)待っても
+        checkmateが来なければ、stopして打ち切った結果を返す"""
         cmd = "go mate"
         if byoyomi is not None:
             cmd += " " + str(byoyomi)
         else:
             cmd += " infinite"
-        self.loop.run_until_complete(self.usi_cmd(cmd))
-        return self.loop.run_until_complete(
-            self.wait_until(["checkmate"], timeout=int(byoyomi / 1000))
-        )
+        if deadline is None:
+            deadline = math.inf if byoyomi is None else byoyomi / 1000 + self.timeout
+        async with self.__command_lock:
+            with tracer.stage("go_mate"):
+                await self.usi_cmd(cmd)
+                return await self.wait_until(
+                    ["checkmate"], timeout=deadline, stoppable=True
+                )
+
+    async def stop_async(self):
+        """go infiniteの後のstopではbestmoveを待つ"""
+        async with self.__command_lock:
+            await self.usi_cmd("stop")
+            return await self.wait_until(["bestmove", "checkmate"])
+
+    def usi_future(self):
+        return self.submit(self.usi_async())
+
+    def isready_future(self):
+        return self.submit(self.isready_async())
+
+    def go_future(
+        self, ponder=False, infinite=False, btime=None, wtime=None, deadline=None
+    ):
+        return self.submit(self.go_async(ponder, infinite, btime, wtime, deadline))
+
+    def go_mate_future(self, byoyomi=None, deadline=None):
+        """詰み探索を始めてFutureを返す、cancel()すると探索をstopで止める"""
+        return self.submit(self.go_mate_async(byoyomi, deadline))
+
+    def usi(self):
+        return self.usi_future().result()
+
+    def isready(self):
+        return self.isready_future().result()
+
+    def setoption(self, name, value):
+        self.submit(self.setoption_async(name, value)).result()
+
+    def position(self, moves=None, sfen="startpos"):
+        self.submit(self.position_async(moves, sfen)).result()
+
+    def go(self, ponder=False, infinite=False, btime=None, wtime=None, deadline=None):
+        return self.go_future(ponder, infinite, btime, wtime, deadline).result()
+
+    def go_mate(self, byoyomi=None, deadline=None):
+        return self.go_mate_future(byoyomi, deadline).result()
 
     def stop(self):
         """go infiniteの後のstopではbestmoveを待つ"""
-        self.stop_nowait()
-        return self.loop.run_until_complete(self.wait_until(["bestmove", "checkmate"]))
+        return self.submit(self.stop_async()).result()
 
     def stop_nowait(self):
-        """go infiniteの後でないstopでは待たない"""
-        self.loop.run_until_complete(self.usi_cmd("stop"))
+        """go infiniteの後でないstopでは待たない
+
+        思考中のgo/go_mateを別スレッドから止める場合にも使え、打ち切った結果はgo/go_mateの戻り値になる"""
+        self.submit(self.usi_cmd("stop")).result()
 
-    async def __quit(self):
+    def is_alive(self):
+        """エンジンのプロセスが動いていて、出力が閉じられていないか"""
+        return self.proc is not None and self.proc.returncode is None and not self.eof
+
+    async def quit_async(self):
         # self.usi_cmd("quit")
-        self.proc.kill()
-        return await self.proc.wait()
+        try:
+            self.proc.kill()
+        except ProcessLookupError:
+            # 既に終了している
+            pass
+        ret = await self.proc.wait()
+        if self.__reader is not None:
+            self.__reader.cancel()
+        self.proc = None
+        return ret
 
     def quit(self):
-        self.loop.run_until_complete(self.__quit())
-        # self.loop.close()
-        self.proc = None
-        self.loop = None
+        if self.loop is None:
+            return
+        try:
+            self.submit(self.quit_async()).result()
+        finally:
+            if self.__loop_thread is not None:
+                self.__loop_thread.stop()
+            self.loop = None
 
 
 if __name__ == "__main__":
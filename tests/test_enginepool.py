@@ -0,0 +1,157 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import sys
+import threading
+
+import pytest
+
+from shogiimagesolver import ImageSolver, UsiEnginePool
+
+pytestmark = pytest.mark.skipif(
+    sys.platform == "win32", reason="スタブのエンジンをシェルスクリプトで起動する"
+)
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "usi_stub.py")
+
+
+@pytest.fixture
+def stub_engine(tmp_path):
+    """USI_STUB_MODEを指定してスタブを起動する実行ファイルを作る"""
+
+    def make(mode, delay=0):
+        path = tmp_path / ("usi_stub_" + mode)
+        path.write_text(
+            "#!/bin/sh\nUSI_STUB_MODE=%s USI_STUB_DELAY=%s exec '%s' '%s'\n"
+            % (mode, delay, sys.executable, STUB)
+        )
+        path.chmod(0o755)
+        return str(path)
+
+    return make
+
+
+def engine_threads():
+    return [t for t in threading.enumerate() if t.name == "usi-loop" and t.is_alive()]
+
+
+def go_mate(pool):
+    with pool.engine() as usi:
+        usi.position(sfen="sfen 9/9/9/9/9/9/9/9/9 b - 1")
+        return (usi, usi.go_mate(200, deadline=0.2))
+
+
+def test_concurrent_solves(stub_engine):
+    solver = ImageSolver(
+        engine=stub_engine("nomate", 0.2),
+        pool_size=2,
+        mate_cache=False,
+        image_cache=False,
+        geometry_cache=False,
+    )
+    results = []
+    try:
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    solver.solve_from_sfen("9/9/9/9/9/9/9/9/9 b - 1")[0]
+                )
+            )
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == ["nomate"] * 5
+        # 借りたエンジンは全て返されている
+        engines = [solver.pool.checkout(timeout=1) for _ in range(2)]
+        assert len(set(engines)) == 2
+        assert all(usi.is_alive() for usi in engines)
+    finally:
+        solver.quit()
+
+
+def test_checkout_timeout(stub_engine):
+    pool = UsiEnginePool(stub_engine("nomate"))
+    try:
+        assert pool.checkout_timeout is not None
+        usi = pool.checkout()
+        with pytest.raises(TimeoutError):
+            pool.checkout(timeout=0.1)
+        pool.checkin(usi)
+        assert pool.checkout(timeout=0.1) is usi
+    finally:
+        pool.quit()
+
+
+def test_eof_engine_is_respawned(stub_engine):
+    pool = UsiEnginePool(stub_engine("eof"), timeout=1)
+    try:
+        (usi, lines) = go_mate(pool)
+        assert lines == []
+        assert not usi.is_alive()
+        with pool.engine(timeout=1) as respawned:
+            assert respawned is not usi
+            assert respawned.is_alive()
+    finally:
+        pool.quit()
+
+
+def test_hanging_engine_is_respawned(stub_engine):
+    pool = UsiEnginePool(stub_engine("hang"), timeout=0.5)
+    try:
+        (usi, lines) = go_mate(pool)
+        assert lines == []
+        assert usi.timed_out
+        with pool.engine(timeout=1) as respawned:
+            assert respawned is not usi
+            assert respawned.is_alive()
+            assert not respawned.timed_out
+    finally:
+        pool.quit()
+
+
+def test_respawn_failure_keeps_slot(stub_engine, tmp_path):
+    engine_cmd = stub_engine("nomate")
+    pool = UsiEnginePool(engine_cmd)
+    try:
+        # 起動し直せなくても、with文の中の例外がそのまま伝わる
+        with pytest.raises(ValueError):
+            with pool.engine() as usi:
+                usi.quit()
+                pool.engine_cmd = str(tmp_path / "missing")
+                raise ValueError("solve failed")
+        # 枠は残っているので、待たされずに起動し直しの失敗がわかる
+        for _ in range(2):
+            with pytest.raises(OSError):
+                pool.checkout(timeout=0.1)
+        pool.engine_cmd = engine_cmd
+        with pool.engine(timeout=0.1) as usi:
+            assert usi.is_alive()
+    finally:
+        pool.quit()
+
+
+@pytest.mark.parametrize("failure", ["exit 1", "exec /nonexistent"])
+def test_startup_failure_quits_started_engines(tmp_path, failure):
+    # 最初の1つだけ起動でき、2つ目からは起動に失敗する
+    count_file = tmp_path / "count"
+    pid_file = tmp_path / "pid"
+    path = tmp_path / "usi_stub_once"
+    path.write_text(
+        "#!/bin/sh\n"
+        "if [ -e '%s' ]; then %s; fi\n"
+        "touch '%s'\n"
+        "echo $$ > '%s'\n"
+        "exec '%s' '%s'\n"
+        % (count_file, failure, count_file, pid_file, sys.executable, STUB)
+    )
+    path.chmod(0o755)
+    threads = engine_threads()
+    with pytest.raises((RuntimeError, OSError)):
+        UsiEnginePool(str(path), size=3, timeout=1)
+    pid = int(pid_file.read_text())
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+    assert engine_threads() == threads
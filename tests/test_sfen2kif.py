@@ -0,0 +1,183 @@
+# -*- coding: UTF-8 -*-
+
+import random
+
+import pytest
+
+from shogiimagesolver import Position, Sfen2kif
+
+HIRATE = "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1"
+
+# python-shogiを使っていたときの出力
+PARSE_MOVES_CASES = [
+    # 打つ手、後手の玉、成駒(圭)の移動
+    (
+        "l3k3l/6G2/2+NSsppGp/pp2p4/5+r3/5s3/1P6P/2P1S1GP1/L1G1K2NL b NPr2bn7p 1",
+        "P*5b 5a6a 7c7b",
+        "▲５二歩打 △６一玉(５一) ▲７二圭(７三) ",
+    ),
+    # 成る手と同
+    (
+        HIRATE,
+        "7g7f 3c3d 8h2b+ 3a2b B*4e",
+        "▲７六歩(７七) △３四歩(３三) ▲２二角成(８八) △同銀(３一) ▲４五角打 ",
+    ),
+    # 後手番から
+    (
+        HIRATE.replace(" b ", " w "),
+        "3c3d 7g7f 2b8h+ 7i8h B*2b",
+        "△３四歩(３三) ▲７六歩(７七) △８八角成(２二) ▲同銀(７九) △２二角打 ",
+    ),
+    (
+        "8k/9/9/9/9/9/9/9/K8 w 2L2Pr 1",
+        "R*9h 9i8i 9h9i+ 8i9i",
+        "△９八飛打 ▲８九玉(９九) △９九飛成(９八) ▲同玉(８九) ",
+    ),
+    (
+        "4k4/9/4P4/9/9/9/9/9/4K4 b GS 1",
+        "5c5b+ 5a5b G*6b 5b4a",
+        "▲５二歩成(５三) △同玉(５一) ▲６二金打 △４一玉(５二) ",
+    ),
+]
+
+
+@pytest.mark.parametrize("sfen, moves, expected", PARSE_MOVES_CASES)
+def test_parse_moves(sfen, moves, expected):
+    assert Sfen2kif.parse_moves(sfen, moves) == expected
+
+
+def test_parse_many():
+    items = [(sfen, moves) for (sfen, moves, _) in PARSE_MOVES_CASES]
+    assert Sfen2kif.parse_many(items) == [kif for (_, _, kif) in PARSE_MOVES_CASES]
+
+
+def test_invalid_moves():
+    with pytest.raises(ValueError):
+        Sfen2kif.parse_moves(HIRATE, "5e5d")
+    with pytest.raises(ValueError):
+        Sfen2kif.parse_moves(HIRATE, "7g7x")
+
+
+def test_kif_file_gote():
+    kif = Sfen2kif.kif_file("8k/9/9/9/9/9/9/9/K8 w 2L2Pr 1", "R*9h 9i8i 9h9i+ 8i9i")
+    lines = kif.splitlines()
+    assert lines[0] == "後手の持駒：飛"
+    assert lines[3] == "| ・ ・ ・ ・ ・ ・ ・ ・v玉|一"
+    assert lines[11] == "| 玉 ・ ・ ・ ・ ・ ・ ・ ・|九"
+    assert lines[13:] == [
+        "先手の持駒：香二　歩二",
+        "後手番",
+        "手数----指手---------消費時間--",
+        "   1 ９八飛打",
+        "   2 ８九玉(99)",
+        "   3 ９九飛成(98)",
+        "   4 同　玉(89)",
+        "まで4手で詰み",
+    ]
+
+
+def test_kif_file_promoted_names():
+    kif = Sfen2kif.kif_file(
+        "4k4/9/4P4/9/9/9/9/9/4K4 b GS 1", "5c5b+ 5a5b G*6b 5b4a", result=None
+    )
+    lines = kif.splitlines()
+    assert lines[0] == "後手の持駒：なし"
+    assert lines[13] == "先手の持駒：金　銀"
+    assert "後手番" not in lines
+    assert lines[-4:] == ["   1 ５二歩成(53)", "   2 同　玉(51)", "   3 ６二金打", "   4 ４一玉(52)"]
+    kif = Sfen2kif.kif_file(
+        "l3k3l/6G2/2+NSsppGp/pp2p4/5+r3/5s3/1P6P/2P1S1GP1/L1G1K2NL b NPr2bn7p 1",
+        "7c7b",
+    )
+    assert kif.splitlines()[-2:] == ["   1 ７二成桂(73)", "まで1手で詰み"]
+
+
+def test_position_sfen():
+    sfen = "ln1g5/1r2S1k2/p2pppn2/2ps2p2/1p7/2P6/PPSPPPPLP/2G2K1+pr/LN4G1b w BGSLP10p 1"
+    position = Position.from_sfen(sfen)
+    assert position.teban == 1
+    assert position.board[9 * 7 + 7] == -(1 + Position.PROMOTED)
+    assert position.board[9 * 8 + 8] == -6
+    assert position.hands[0] == [0, 1, 1, 0, 1, 1, 1, 0, 0]
+    assert position.hands[1] == [0, 10, 0, 0, 0, 0, 0, 0, 0]
+    # 持ち駒は歩から飛の順に並べる
+    assert position.sfen() == sfen.replace("BGSLP10p", "PLSGB10p")
+    assert Position.from_sfen(position.sfen()).sfen() == position.sfen()
+
+
+def test_position_csa():
+    position = Position.from_sfen("4k4/9/4P4/9/9/9/9/9/4K4 b GS2p 1")
+    assert position.csa().splitlines() == [
+        "P1 *  *  *  * -OU *  *  *  * ",
+        "P2 *  *  *  *  *  *  *  *  * ",
+        "P3 *  *  *  * +FU *  *  *  * ",
+        "P4 *  *  *  *  *  *  *  *  * ",
+        "P5 *  *  *  *  *  *  *  *  * ",
+        "P6 *  *  *  *  *  *  *  *  * ",
+        "P7 *  *  *  *  *  *  *  *  * ",
+        "P8 *  *  *  *  *  *  *  *  * ",
+        "P9 *  *  *  * +OU *  *  *  * ",
+        "P+00GI",
+        "P+00KI",
+        "P-00FU00FU",
+        "+",
+    ]
+    assert position.koma_count() == [0, 3, 0, 0, 1, 1, 0, 0, 2]
+
+
+def test_position_invalid_sfen():
+    for sfen in ["", "lnsgkgsnl/9 x - 1", "4k4/9/9/9/9/9/9/9/4Q4 b - 1"]:
+        with pytest.raises(ValueError):
+            Position.from_sfen(sfen)
+
+
+def reference_parse_moves(shogi, sfen, sfen_moves):
+    """python-shogiで盤面を進めて棋譜にする(表引きにする前の実装)"""
+    board = shogi.Board(sfen)
+    teban = 0 if board.turn == shogi.BLACK else 1
+    pre_pos = None
+    kif = ""
+    for move in sfen_moves.split():
+        to_pos = move[2:4]
+        pos_str = "同" if pre_pos == to_pos else Sfen2kif.str2pos(move[2], move[3])
+        if move[1] == "*":
+            koma = shogi.Piece.from_symbol(move[0])
+        else:
+            koma = board.piece_at((9 - int(move[0])) + 9 * (ord(move[1]) - ord("a")))
+        koma_str = koma.japanese_symbol() + ("成" if move[4:5] == "+" else "")
+        if move[1] == "*":
+            kif += "▲△"[teban] + pos_str + koma_str + "打 "
+        else:
+            from_str = Sfen2kif.str2pos(move[0], move[1])
+            kif += "▲△"[teban] + pos_str + koma_str + "(" + from_str + ") "
+        pre_pos = to_pos
+        board.push(shogi.Move.from_usi(move))
+        teban = 1 - teban
+    return kif
+
+
+def test_random_games_match_python_shogi():
+    shogi = pytest.importorskip("shogi")
+    rng = random.Random(0)
+    for _ in range(30):
+        board = shogi.Board()
+        for _ in range(rng.randrange(20, 80)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        sfen = board.sfen()
+        position = Position.from_sfen(sfen)
+        assert position.sfen().split()[:2] == sfen.split()[:2]
+        sfen_moves = []
+        for _ in range(30):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = rng.choice(moves)
+            sfen_moves.append(move.usi())
+            board.push(move)
+        sfen_moves = " ".join(sfen_moves)
+        assert Sfen2kif.parse_moves(sfen, sfen_moves) == reference_parse_moves(
+            shogi, sfen, sfen_moves
+        )
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import sys
+import time
+
+"""テスト用のUSIプロトコル詰将棋エンジンのスタブ
+
+環境変数USI_STUB_MODEで、go mateへの応答を変える
+    nomate: USI_STUB_DELAY秒後に checkmate nomate を返す
+    eof: go mateを受け取ると終了する(出力がEOFになる)
+    hang: go mateにもstopにも応答しない"""
+
+mode = os.environ.get("USI_STUB_MODE", "nomate")
+delay = float(os.environ.get("USI_STUB_DELAY", "0"))
+
+
+def out(line):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+for line in sys.stdin:
+    cmd = line.strip()
+    if cmd == "usi":
+        out("id name usi_stub")
+        out("usiok")
+    elif cmd == "isready":
+        out("readyok")
+    elif cmd.startswith("go"):
+        if mode == "eof":
+            break
+        if mode == "nomate":
+            time.sleep(delay)
+            out("checkmate nomate")
+    elif cmd == "quit":
+        break